@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import re
+import functools
+import collections
+
+# Sheets range notation
+# Parsed range has sheet (None if not qualified), name (for named ranges) and 1-based bounds, bounds not set in notation are None:
+#   Sheet1!A1:F10 - all bounds
+#   A:F           - rows open
+#   2:10          - columns open
+#   A5:F          - last row open
+#   'My Sheet'    - whole sheet, all bounds open, quoted name is always a sheet
+#   R1C1:R10C6    - R1C1 notation, returned bounds are the same as for A1
+#   NamedRange    - bare name is named range or sheet, API resolves it, so bounds are unknown
+
+A1Range = collections.namedtuple("A1Range", ["sheet", "name", "left_column", "first_row", "right_column", "last_row"])
+
+A1_MAX_COLUMNS = 18278  # ZZZ
+A1_CELL = re.compile(r"^([A-Za-z]{0,3})([0-9]*)$")
+R1C1_CELL = re.compile(r"^(?:[Rr]([0-9]+))?(?:[Cc]([0-9]+))?$")
+A1_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+
+@functools.lru_cache(maxsize=4096)
+def a1_column_number(letters):
+
+    if not letters or not letters.isalpha():
+        raise ValueError("Column {0} is not valid".format(letters))
+
+    num = 0
+    for c in letters.upper():
+        num = num * 26 + (ord(c) - ord('A')) + 1
+
+    return num
+
+@functools.lru_cache(maxsize=4096)
+def a1_column_letters(num):
+
+    if num < 1 or num > A1_MAX_COLUMNS:
+        raise ValueError("Column number {0} is out of range".format(num))
+
+    letters = ""
+    while num > 0:
+        num, rem = divmod(num - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+
+    return letters
+
+# Sheet name is quoted if it has anything but letters, digits and underscore, quotes are doubled
+def a1_sheet(sheet):
+
+    if re.match(r"^[A-Za-z0-9_]+$", sheet):
+        return sheet
+
+    return "'{0}'".format(sheet.replace("'", "''"))
+
+def a1_split_sheet(range_id):
+
+    if range_id.startswith("'"):
+        # Quoted sheet name, '' is escaped quote
+        end = 1
+        while True:
+            end = range_id.find("'", end)
+            if end == -1:
+                raise ValueError("Range {0} has unterminated sheet name".format(range_id))
+            if range_id[end + 1:end + 2] == "'":
+                end += 2
+                continue
+            break
+        sheet = range_id[1:end].replace("''", "'")
+        rest = range_id[end + 1:]
+        if rest == "":
+            return sheet, None
+        if not rest.startswith("!"):
+            raise ValueError("Range {0} is not valid".format(range_id))
+        return sheet, rest[1:]
+
+    if "!" in range_id:
+        sheet, rest = range_id.split("!", 1)
+        return sheet, rest
+
+    return None, range_id
+
+def a1_parse_cell(cell, range_id):
+
+    match = A1_CELL.match(cell)
+    if match and cell:
+        letters, digits = match.groups()
+        column = a1_column_number(letters) if letters else None
+        row = int(digits) if digits else None
+        if row == 0:
+            raise ValueError("Range {0} has row 0".format(range_id))
+        return column, row
+
+    match = R1C1_CELL.match(cell)
+    if match and cell:
+        row, column = match.groups()
+        row = int(row) if row else None
+        column = int(column) if column else None
+        if row == 0 or column == 0:
+            raise ValueError("Range {0} has row or column 0".format(range_id))
+        return column, row
+
+    return None
+
+@functools.lru_cache(maxsize=1024)
+def a1_parse(range_id):
+
+    sheet, cells = a1_split_sheet(range_id.strip())
+
+    # Whole sheet
+    if cells is None:
+        return A1Range(sheet, None, None, None, None, None)
+
+    corners = cells.split(":")
+    if len(corners) > 2:
+        raise ValueError("Range {0} is not valid".format(range_id))
+
+    parsed = [a1_parse_cell(corner, range_id) for corner in corners]
+
+    # Single cell needs both column and row, anything else alone is named range, which is never sheet qualified
+    if len(parsed) == 1:
+        if parsed[0] is None or None in parsed[0]:
+            if sheet is None and A1_NAME.match(cells):
+                return A1Range(None, cells, None, None, None, None)
+            raise ValueError("Range {0} is not valid".format(range_id))
+        parsed = parsed * 2
+
+    if None in parsed:
+        raise ValueError("Range {0} is not valid".format(range_id))
+
+    (left_column, first_row), (right_column, last_row) = parsed
+
+    if left_column is not None and right_column is not None and right_column < left_column:
+        raise ValueError("Range {0} has right column before left column".format(range_id))
+    if first_row is not None and last_row is not None and last_row < first_row:
+        raise ValueError("Range {0} has last row before first row".format(range_id))
+
+    return A1Range(sheet, None, left_column, first_row, right_column, last_row)
+
+# Columns of range, open bounds are taken from sheet column count
+def a1_width(a1_range, column_count=None):
+
+    left_column = a1_range.left_column or 1
+    right_column = a1_range.right_column or column_count
+
+    if right_column is None:
+        raise ValueError("Width of range {0} is unknown without sheet column count".format(a1_format(a1_range)))
+
+    return right_column - left_column + 1
+
+# Rows of range, open bounds are taken from sheet row count
+def a1_height(a1_range, row_count=None):
+
+    first_row = a1_range.first_row or 1
+    last_row = a1_range.last_row or row_count
+
+    if last_row is None:
+        raise ValueError("Height of range {0} is unknown without sheet row count".format(a1_format(a1_range)))
+
+    return last_row - first_row + 1
+
+def a1_format(a1_range):
+
+    if a1_range.name is not None:
+        return a1_range.name
+
+    cells = ""
+    if a1_range.left_column is not None or a1_range.first_row is not None:
+        left = a1_column_letters(a1_range.left_column) if a1_range.left_column is not None else ""
+        right = a1_column_letters(a1_range.right_column) if a1_range.right_column is not None else ""
+        first = str(a1_range.first_row) if a1_range.first_row is not None else ""
+        last = str(a1_range.last_row) if a1_range.last_row is not None else ""
+        cells = "{0}{1}:{2}{3}".format(left, first, right, last)
+
+    if a1_range.sheet is None:
+        return cells
+    if cells == "":
+        return a1_sheet(a1_range.sheet)
+
+    return "{0}!{1}".format(a1_sheet(a1_range.sheet), cells)
+
+# Sheets API omits row tails if their values are empty, pad every row to width with empty strings
+def a1_pad_rows(values, width):
+
+    return [row + [""] * (width - len(row)) if len(row) < width else row for row in values]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Import common code
+from sysadmws_common import *
+from gsuite_scripts import *
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Constants
+LOGO="G Suite Scripts / Batch"
+LOG_DIR = os.environ.get("LOG_DIR")
+if LOG_DIR is None:
+    LOG_DIR = "log"
+LOG_FILE = "batch.log"
+SA_SECRETS_FILE = os.environ.get("SA_SECRETS_FILE")
+BATCH_WORKERS = 4
+
+# Manifest is either a list of documents or a dict with documents list and optional workers
+def load_manifest(manifest_file, logger):
+
+    if manifest_file.endswith(".json"):
+        with open(manifest_file, "r") as f:
+            manifest = load_json(f, logger)
+    else:
+        manifest = load_yaml(manifest_file, logger)
+
+    if isinstance(manifest, list):
+        manifest = {'documents': manifest}
+
+    check_key('documents', manifest)
+
+    for document in manifest['documents']:
+        for key in ['template', 'folder', 'name']:
+            check_key(key, document)
+
+    return manifest
+
+# Existence of every document and its unfinished copy checked with batch requests, per drive user
+# Returns dict (folder, name) -> ID or None, documents missing in it are checked one by one
+def batch_found(documents, logger):
+
+    pairs = {}
+    for document in documents:
+        # Invalid documents fail on their own
+        if 'folder' not in document or 'name' not in document:
+            continue
+        for name in [document['name'], BATCH_PART_NAME.format(document['name'])]:
+            pairs.setdefault(document.get('user'), set()).add((document['folder'], name))
+
+    found = {}
+    for drive_user in pairs:
+        try:
+            found.update(drive_find_many(SA_SECRETS_FILE, list(pairs[drive_user]), drive_user))
+        except Exception as e:
+            logger.exception(e)
+
+    return found
+
+# Main
+
+def main(argv=None):
+
+    # Set parser and parse args
+    parser = argparse.ArgumentParser(description='Script to generate many documents (copy template, fill, export pdf, create draft) defined by YAML or JSON manifest.')
+    parser.add_argument("--debug",              dest="debug",               help="enable debug",                        action="store_true")
+    manifest_help = "YAML or JSON (by .json extension) manifest FILE with documents to generate"
+    parser.add_argument("--manifest",           dest="manifest",            help=manifest_help,                         nargs=1,    metavar=("FILE"),   required=True)
+    workers_help = "process up to N documents concurrently, overrides manifest workers, {0} by default".format(BATCH_WORKERS)
+    parser.add_argument("--workers",            dest="workers",             help=workers_help,                          nargs=1,    metavar=("N"),      type=int)
+    args = parser.parse_args(argv)
+
+    # Set logger and console debug
+    if args.debug:
+        logger = set_logger(logging.DEBUG, LOG_DIR, LOG_FILE)
+    else:
+        logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
+
+    # Catch exception to logger
+
+    try:
+
+        logger.info(LOGO)
+        logger.info("Starting script")
+
+        # Check env vars and connects
+        if SA_SECRETS_FILE is None:
+            raise Exception("Env var SA_SECRETS_FILE missing")
+
+        manifest_file, = args.manifest
+        manifest = load_manifest(manifest_file, logger)
+
+        if args.workers:
+            workers, = args.workers
+        else:
+            workers = int(manifest.get('workers', BATCH_WORKERS))
+
+        # Do tasks
+        # Documents are independent, failed document does not stop others, results are printed as json lines in order of completion
+
+        failed = 0
+
+        found = batch_found(manifest['documents'], logger)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            futures = {}
+            for document in manifest['documents']:
+                futures[executor.submit(batch_document, SA_SECRETS_FILE, document, True, found)] = document
+
+            for future in as_completed(futures):
+
+                document = futures[future]
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    result = {'name': document['name'], 'status': "failed", 'error': str(e)}
+                    failed += 1
+
+                print(json.dumps(result), flush=True)
+                logger.info(json.dumps(result))
+
+        if failed:
+            raise Exception('{0} of {1} documents failed'.format(failed, len(manifest['documents'])))
+
+    # Reroute catched exception to log
+    except Exception as e:
+        logger.exception(e)
+        logger.info("Finished script with errors")
+        return 1
+
+    logger.info("Finished script")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
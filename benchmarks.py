@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmarks of client side work done before API is called, no credentials or network needed
+# Usage: python3 benchmarks.py [--cells N [N ...]] [--columns N] [--repeat N] [--pad-cells N]
+import sys
+import json
+import time
+import argparse
+
+from docs_model import DocsDocument
+from docs_requests import docs_replace_all_text_requests, docs_insert_table_rows_requests
+from a1 import a1_parse, a1_width, a1_pad_rows
+
+# Constants
+BENCH_CELLS = [10000, 50000, 100000]
+BENCH_COLUMNS = 5
+BENCH_REPEAT = 3
+BENCH_PAD_CELLS = 1000000
+BENCH_PAD_COLUMNS = 20
+
+# Documents.get response with one table of given size, indexed as Docs API does
+def bench_docs_response(rows, columns):
+
+    table_rows = []
+    index = 2
+    for row_n in range(rows):
+        cells = []
+        row_start = index
+        index += 1
+        for cell_n in range(columns):
+            cells.append({'startIndex': index, 'endIndex': index + 2, 'content': [{'startIndex': index + 1, 'endIndex': index + 2}]})
+            index += 2
+        table_rows.append({'startIndex': row_start, 'endIndex': index, 'tableCells': cells})
+
+    return {
+        'documentId': "bench",
+        'revisionId': "bench",
+        'body': {
+            'content': [
+                {'startIndex': 1, 'endIndex': index + 1, 'table': {'columns': columns, 'tableRows': table_rows}}
+            ]
+        }
+    }
+
+# Best of repeat runs in seconds
+def bench(func, repeat):
+
+    best = None
+    for run in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def bench_report(name, cells, seconds):
+    print("{0:<32} {1:>8} cells {2:>10.2f} ms {3:>8.0f} ns/cell".format(name, cells, seconds * 1000, seconds * 1e9 / cells), flush=True)
+
+# Main
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of request building for large documents and padding of large sheet values.')
+    parser.add_argument("--cells",      dest="cells",       help="table sizes in cells, {0} by default".format(" ".join(str(cells) for cells in BENCH_CELLS)),    nargs="+",  metavar=("N"),  type=int,   default=BENCH_CELLS)
+    parser.add_argument("--columns",    dest="columns",     help="table columns, {0} by default".format(BENCH_COLUMNS),                                                         metavar=("N"),  type=int,   default=BENCH_COLUMNS)
+    parser.add_argument("--repeat",     dest="repeat",      help="runs of each benchmark, best is reported, {0} by default".format(BENCH_REPEAT),                              metavar=("N"),  type=int,   default=BENCH_REPEAT)
+    parser.add_argument("--pad-cells",  dest="pad_cells",   help="cells of sheet values to pad, {0} by default".format(BENCH_PAD_CELLS),                                           metavar=("N"),  type=int,   default=BENCH_PAD_CELLS)
+    args = parser.parse_args(argv)
+
+    for cells in args.cells:
+
+        rows = max(1, cells // args.columns)
+        cells = rows * args.columns
+
+        json_list = [["Row {0} cell {1}".format(row_n, cell_n) for cell_n in range(args.columns)] for row_n in range(rows)]
+        replacements = {"__KEY{0}__".format(cell_n): "Value {0}".format(cell_n) for cell_n in range(cells)}
+        response = bench_docs_response(1, args.columns)
+        large_response = bench_docs_response(rows, args.columns)
+
+        document = DocsDocument(response)
+
+        bench_report("docs_model load", cells, bench(lambda: DocsDocument(large_response), args.repeat))
+        bench_report("docs_insert_table_rows_requests", cells, bench(lambda: docs_insert_table_rows_requests(document, 1, 1, json_list), args.repeat))
+        bench_report("docs_replace_all_text_requests", cells, bench(lambda: docs_replace_all_text_requests(replacements), args.repeat))
+        bench_report("docs_model inserted_rows", cells, bench(lambda: DocsDocument(response).inserted_rows(1, 1, json_list), args.repeat))
+
+        requests = docs_insert_table_rows_requests(document, 1, 1, json_list)
+        bench_report("batchUpdate body json", cells, bench(lambda: json.dumps({'requests': requests}), args.repeat))
+
+    # Sheets values with row tails omitted, as API returns them
+    rows = max(1, args.pad_cells // BENCH_PAD_COLUMNS)
+    pad_cells = rows * BENCH_PAD_COLUMNS
+    values = [["x"] * (row_n % (BENCH_PAD_COLUMNS + 1)) for row_n in range(rows)]
+    width = a1_width(a1_parse("Sheet1!A1:{0}{1}".format(chr(ord('A') + BENCH_PAD_COLUMNS - 1), rows)))
+
+    bench_report("a1_pad_rows", pad_cells, bench(lambda: a1_pad_rows(values, width), args.repeat))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
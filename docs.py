@@ -15,7 +15,7 @@ SA_SECRETS_FILE = os.environ.get("SA_SECRETS_FILE")
 
 # Main
 
-if __name__ == "__main__":
+def main(argv=None):
 
     # Set parser and parse args
     parser = argparse.ArgumentParser(description='Script to automate specific operations with G Suite Docs.')
@@ -28,7 +28,11 @@ if __name__ == "__main__":
     group.add_argument("--insert-table-rows",   dest="insert_table_rows",   help=insert_table_rows_help,                nargs=4,    metavar=("ID", "TABLE_NUM", "BELOW_ROW_NUMBER", "JSON"))
     delete_table_row_help = "delete row ROW_NUMBER from TABLE_NUM (table, row count starts from 1) within google drive doc ID"
     group.add_argument("--delete-table-row",    dest="delete_table_row",    help=delete_table_row_help,                 nargs=3,    metavar=("ID", "TABLE_NUM", "ROW_NUMBER"))
-    args = parser.parse_args()
+    fill_table_rows_help = "the same as --insert-table-rows for large tables: insert empty rows, then fill cells by their real positions, in batch updates of limited size"
+    group.add_argument("--fill-table-rows",     dest="fill_table_rows",     help=fill_table_rows_help,                  nargs=4,    metavar=("ID", "TABLE_NUM", "BELOW_ROW_NUMBER", "JSON"))
+    edit_plan_help = "apply edits defined by JSON (e.g. '{\"replace_all_text\": {\"__KEY1__\": \"Value 1\"}, \"insert_table_rows\": [{\"table_num\": 1, \"below_row_number\": 1, \"rows\": [[\"Cell 1-1\", \"Cell 1-2\"]]}], \"delete_table_rows\": [{\"table_num\": 2, \"row_number\": 3}]}') within google drive doc ID in one batch update, table and row numbers refer to the doc before edits"
+    group.add_argument("--edit-plan",           dest="edit_plan",           help=edit_plan_help,                        nargs=2,    metavar=("ID", "JSON"))
+    args = parser.parse_args(argv)
 
     # Set logger and console debug
     if args.debug:
@@ -91,6 +95,21 @@ if __name__ == "__main__":
             except Exception as e:
                 raise Exception('Document {0} inserting row json {1} below {2} into table {3} failed'.format(doc_id, json_str, below_row_number, table_num))
 
+        if args.fill_table_rows:
+
+            try:
+
+                doc_id, table_num, below_row_number, json_str = args.fill_table_rows
+
+                responses = docs_fill_table_rows(SA_SECRETS_FILE, doc_id, table_num, below_row_number, json_str)
+
+                for response in responses:
+                    print(response)
+                    logger.info(response)
+
+            except Exception as e:
+                raise Exception('Document {0} filling rows json {1} below {2} into table {3} failed'.format(doc_id, json_str, below_row_number, table_num))
+
         if args.delete_table_row:
             
             try:
@@ -104,11 +123,29 @@ if __name__ == "__main__":
 
             except Exception as e:
                 raise Exception('Document {0} deleting row {1} from table {2} failed'.format(doc_id, row_number, table_num))
+
+        if args.edit_plan:
+
+            try:
+
+                doc_id, json_str = args.edit_plan
+
+                response = docs_apply_edit_plan(SA_SECRETS_FILE, doc_id, json_str)
+
+                print(response)
+                logger.info(response)
+
+            except Exception as e:
+                raise Exception('Document {0} applying edit plan {1} failed'.format(doc_id, json_str))
             
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
         logger.info("Finished script with errors")
-        sys.exit(1)
+        return 1
 
     logger.info("Finished script")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Tables of Google Docs document indexed by position in one pass over body content
+# Model is kept in sync with edits made through it, so several edits need only one documents().get()
+# Indices are in UTF-16 code units, like in Docs API
+
+# Only what is needed to locate tables, rows and cells
+DOCS_MODEL_FIELDS = "documentId,revisionId,body(content(startIndex,endIndex,table(columns,tableRows(startIndex,endIndex,tableCells(startIndex,endIndex,content(startIndex,endIndex))))))"
+
+def docs_text_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+class DocsDocument(object):
+
+    def __init__(self, response):
+        self.load(response)
+
+    def load(self, response):
+
+        self.doc_id = response.get('documentId')
+        self.revision_id = response.get('revisionId')
+        self.tables = []
+
+        for element in response['body']['content']:
+
+            if "table" not in element:
+                continue
+
+            rows = []
+            for row in element['table'].get('tableRows', []):
+                cells = []
+                for cell in row.get('tableCells', []):
+                    cells.append({
+                        'startIndex': cell['startIndex'],
+                        'endIndex': cell['endIndex'],
+                        'contentStartIndex': cell['content'][0]['startIndex']
+                    })
+                rows.append({
+                    'startIndex': row['startIndex'],
+                    'endIndex': row['endIndex'],
+                    'cells': cells
+                })
+
+            self.tables.append({
+                'startIndex': element['startIndex'],
+                'endIndex': element['endIndex'],
+                'rows': rows
+            })
+
+        # Set by edits which cannot be tracked locally (e.g. replaceAllText), document should be fetched again before next edit
+        self.stale = False
+
+    # Table and row numbers start from 1
+
+    def table(self, table_num):
+        table_num = int(table_num)
+        if table_num < 1 or table_num > len(self.tables):
+            raise ValueError("Table index for TABLE_NUM = {0} not found".format(table_num))
+        return self.tables[table_num - 1]
+
+    def row(self, table_num, row_number):
+        table = self.table(table_num)
+        row_number = int(row_number)
+        if row_number > len(table['rows']):
+            raise ValueError("Table {0} has less than {1} rows ({2} actually)".format(table_num, row_number, len(table['rows'])))
+        if row_number < 1:
+            raise ValueError("Row {0} index for table {1} not found".format(row_number, table_num))
+        return table['rows'][row_number - 1]
+
+    # Move everything after index by delta
+    # Starts equal to index are moved only when content is inserted before them (new row), not into them (text)
+    def shift(self, index, delta, starts_inclusive):
+
+        def moved_start(start):
+            if start > index or (starts_inclusive and start == index):
+                return start + delta
+            return start
+
+        def moved_end(end):
+            if end > index:
+                return end + delta
+            return end
+
+        for table in self.tables:
+            table['startIndex'] = moved_start(table['startIndex'])
+            table['endIndex'] = moved_end(table['endIndex'])
+            for row in table['rows']:
+                row['startIndex'] = moved_start(row['startIndex'])
+                row['endIndex'] = moved_end(row['endIndex'])
+                for cell in row['cells']:
+                    cell['startIndex'] = moved_start(cell['startIndex'])
+                    cell['contentStartIndex'] = moved_start(cell['contentStartIndex'])
+                    cell['endIndex'] = moved_end(cell['endIndex'])
+
+    # Track rows inserted with insertTableRow below row_number and filled with insertText, rows are lists of cell texts
+    # New row has the same cells as the row below which it is inserted, empty cell takes 2 indices (cell start and paragraph end)
+    def inserted_rows(self, table_num, below_row_number, rows):
+
+        table = self.table(table_num)
+        below_row = self.row(table_num, below_row_number)
+        cell_count = len(below_row['cells'])
+
+        new_rows = []
+        row_start = below_row['endIndex']
+
+        for list_row in rows:
+            cells = []
+            cell_start = row_start + 1
+            for cell_n in range(cell_count):
+                if cell_n < len(list_row):
+                    text_length = docs_text_length(list_row[cell_n])
+                else:
+                    text_length = 0
+                cells.append({
+                    'startIndex': cell_start,
+                    'endIndex': cell_start + 2 + text_length,
+                    'contentStartIndex': cell_start + 1
+                })
+                cell_start = cell_start + 2 + text_length
+            new_rows.append({
+                'startIndex': row_start,
+                'endIndex': cell_start,
+                'cells': cells
+            })
+            row_start = cell_start
+
+        self.shift(below_row['endIndex'], row_start - below_row['endIndex'], True)
+
+        below_row_index = table['rows'].index(below_row)
+        table['rows'][below_row_index + 1:below_row_index + 1] = new_rows
+
+    # Track row deleted with deleteTableRow
+    def deleted_row(self, table_num, row_number):
+
+        table = self.table(table_num)
+        row = self.row(table_num, row_number)
+
+        table['rows'].remove(row)
+        self.shift(row['endIndex'], row['startIndex'] - row['endIndex'], True)
+
+    # Track successful batchUpdate, its response has revision required for the next one
+    def updated(self, response):
+        write_control = response.get('writeControl', {})
+        if 'requiredRevisionId' in write_control:
+            self.revision_id = write_control['requiredRevisionId']
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Builders of Docs API batchUpdate requests
+# Requests are appended to one list, so build time is linear in the number of cells, inputs are never modified
+# Table positions are taken from docs_model.DocsDocument
+import json
+
+def docs_replace_all_text_requests(replacements, requests=None):
+
+    if requests is None:
+        requests = []
+
+    for template in replacements:
+
+        requests.append({
+            'replaceAllText': {
+                'containsText': {
+                    'text': template,
+                    'matchCase':  'true'
+                },
+                'replaceText': replacements[template]
+            }
+        })
+
+    return requests
+
+# Rows are list of lists of cell texts, inserted below row number of table
+def docs_insert_table_rows_requests(document, table_num, below_row_number, rows, requests=None):
+
+    if requests is None:
+        requests = []
+
+    below_row_index = int(below_row_number) - 1
+
+    # Get table index and endIndex of the row below which we will insert
+    # We can calc new row first cell startIndex by this endIndex
+
+    table_index = document.table(table_num)['startIndex']
+    below_row = document.row(table_num, below_row_number)
+    row_end_index = below_row['endIndex']
+    cell_count = len(below_row['cells'])
+
+    # All inserted rows are the same except texts
+    insert_row = {
+        'insertTableRow': {
+            'tableCellLocation': {
+                'tableStartLocation': {
+                    'index': table_index
+                },
+                'rowIndex': below_row_index,
+                'columnIndex': 0
+            },
+            'insertBelow': 'true'
+        }
+    }
+
+    # Iterate on rows starting from last row
+    # As per https://developers.google.com/docs/api/how-tos/best-practices data should be filled backwards
+
+    for row_n in range(len(rows) - 1, -1, -1):
+
+        list_row = rows[row_n]
+
+        if len(list_row) > cell_count:
+            raise ValueError("Row {0} has more cells than {1} cells of table {2}".format(list_row, cell_count, table_num))
+
+        requests.append(insert_row)
+
+        # Fill row values, also backwards
+        # Empty cell of new row takes 2 indices, so cell N content starts at row_end_index + 2 * N
+
+        for cell_n in range(len(list_row) - 1, -1, -1):
+
+            requests.append({
+                'insertText': {
+                    'location': {
+                        'index': row_end_index + 2 * (cell_n + 1)
+                    },
+                    'text': list_row[cell_n]
+                }
+            })
+
+    return requests
+
+def docs_delete_table_row_requests(document, table_num, row_number, requests=None):
+
+    if requests is None:
+        requests = []
+
+    row_index = int(row_number) - 1
+
+    # Get table index, check row exists
+
+    table_index = document.table(table_num)['startIndex']
+    document.row(table_num, row_number)
+
+    requests.append({
+        'deleteTableRow': {
+            'tableCellLocation': {
+                'tableStartLocation': {
+                    'index': table_index
+                },
+                'rowIndex': row_index,
+                'columnIndex': 0
+            }
+        }
+    })
+
+    return requests
+
+# Empty rows are inserted all at the same place, order of the requests does not matter
+def docs_insert_empty_table_rows_requests(document, table_num, below_row_number, count, requests=None):
+
+    if requests is None:
+        requests = []
+
+    below_row_index = int(below_row_number) - 1
+
+    table_index = document.table(table_num)['startIndex']
+    document.row(table_num, below_row_number)
+
+    insert_row = {
+        'insertTableRow': {
+            'tableCellLocation': {
+                'tableStartLocation': {
+                    'index': table_index
+                },
+                'rowIndex': below_row_index,
+                'columnIndex': 0
+            },
+            'insertBelow': 'true'
+        }
+    }
+
+    for row_n in range(count):
+        requests.append(insert_row)
+
+    return requests
+
+# Fill existing rows starting from row number with texts, backwards, by real cell content indices
+# Empty texts need no requests
+def docs_fill_table_cells_requests(document, table_num, first_row_number, rows, requests=None):
+
+    if requests is None:
+        requests = []
+
+    first_row_number = int(first_row_number)
+
+    for row_n in range(len(rows) - 1, -1, -1):
+
+        list_row = rows[row_n]
+        cells = document.row(table_num, first_row_number + row_n)['cells']
+
+        if len(list_row) > len(cells):
+            raise ValueError("Row {0} has more cells than {1} cells of table {2}".format(list_row, len(cells), table_num))
+
+        for cell_n in range(len(list_row) - 1, -1, -1):
+
+            if list_row[cell_n] == "":
+                continue
+
+            requests.append({
+                'insertText': {
+                    'location': {
+                        'index': cells[cell_n]['contentStartIndex']
+                    },
+                    'text': list_row[cell_n]
+                }
+            })
+
+    return requests
+
+# Split requests into consecutive chunks of at most max_requests requests and about max_bytes of JSON each
+# Request larger than max_bytes makes a chunk of its own
+def docs_requests_chunks(requests, max_requests, max_bytes):
+
+    chunk = []
+    chunk_bytes = 0
+
+    for request in requests:
+
+        request_bytes = len(json.dumps(request)) + 2
+
+        if chunk and (len(chunk) >= max_requests or chunk_bytes + request_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(request)
+        chunk_bytes += request_bytes
+
+    if chunk:
+        yield chunk
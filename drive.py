@@ -4,6 +4,7 @@
 # Import common code
 from sysadmws_common import *
 from gsuite_scripts import *
+import csv
 
 # Constants
 LOGO="G Suite Scripts / Drive"
@@ -12,10 +13,29 @@ if LOG_DIR is None:
     LOG_DIR = "log"
 LOG_FILE = "drive.log"
 SA_SECRETS_FILE = os.environ.get("SA_SECRETS_FILE")
+OUTPUT_FORMATS = ["text", "jsonl", "csv"]
+
+# Listing output, flushed per line so it streams while pages arrive
+
+def print_header(fields, output_format):
+    if output_format == "csv":
+        csv.writer(sys.stdout).writerow(fields)
+        sys.stdout.flush()
+
+def print_item(item, fields, output_format):
+    line = ' '.join([str(item[field]) for field in fields])
+    if output_format == "jsonl":
+        print(json.dumps(dict([(field, item[field]) for field in fields])), flush=True)
+    elif output_format == "csv":
+        csv.writer(sys.stdout).writerow([item[field] for field in fields])
+        sys.stdout.flush()
+    else:
+        print(line, flush=True)
+    return line
 
 # Main
 
-if __name__ == "__main__":
+def main(argv=None):
 
     # Set parser and parse args
     parser = argparse.ArgumentParser(description='Script to automate specific operations with G Suite Drive.')
@@ -24,17 +44,38 @@ if __name__ == "__main__":
     user_help = "impersonate USER using domain wide delegation"
     parser.add_argument("--user",               dest="user",                help=user_help,                             nargs=1,    metavar=("USER"))
 
+    chunk_size_help = "upload and download by chunks of BYTES, multiple of 256 KiB, {0} by default".format(DRIVE_CHUNK_SIZE)
+    parser.add_argument("--chunk-size",         dest="chunk_size",          help=chunk_size_help,                       nargs=1,    metavar=("BYTES"),  type=int)
+
+    format_help = "output format of listings: text (default), jsonl or csv"
+    parser.add_argument("--format",             dest="format",              help=format_help,                           nargs=1,    metavar=("FORMAT"), choices=OUTPUT_FORMATS)
+
+    workers_help = "use up to N concurrent requests where supported, {0} by default".format(DRIVE_WORKERS)
+    parser.add_argument("--workers",            dest="workers",             help=workers_help,                          nargs=1,    metavar=("N"),      type=int)
+
     group = parser.add_mutually_exclusive_group(required=True)
 
     ls_help = "returns 'id name mimeType' of files available in folder ID, use ID = ALL to list all available files"
     group.add_argument("--ls",                  dest="ls",                  help=ls_help,                               nargs=1,    metavar=("ID"))
 
+    ls_recursive_help = "returns 'id path mimeType' of files available in folder ID and all its subfolders, output is streamed while subfolders are listed concurrently"
+    group.add_argument("--ls-recursive",        dest="ls_recursive",        help=ls_recursive_help,                     nargs=1,    metavar=("ID"))
+
     ls_perms_help = "returns 'id type emailAddress role' permissions of of file or folder ID"
     group.add_argument("--ls-perms",            dest="ls_perms",            help=ls_perms_help,                         nargs=1,    metavar=("ID"))
 
+    ls_perms_many_help = "returns 'file_id id type emailAddress role' permissions of files or folders listed with json list JSON using batch requests"
+    group.add_argument("--ls-perms-many",       dest="ls_perms_many",       help=ls_perms_many_help,                    nargs=1,    metavar=("JSON"))
+
+    find_many_help = "check existence of files named NAME within folders ID listed with json list JSON (e.g. '[[\"ID\", \"NAME\"]]') using batch requests, returns 'id name file_id' or 'id name none' per pair"
+    group.add_argument("--find-many",           dest="find_many",           help=find_many_help,                        nargs=1,    metavar=("JSON"))
+
     rm_help = "delete file ID (folders are also files in drive)"
     group.add_argument("--rm",                  dest="rm",                  help=rm_help,                               nargs=1,    metavar=("ID"))
 
+    rm_many_help = "delete files listed with json list JSON (e.g. '[\"ID1\", \"ID2\"]') using batch requests, returns 'id ok' or 'id error' per file"
+    group.add_argument("--rm-many",             dest="rm_many",             help=rm_many_help,                          nargs=1,    metavar=("JSON"))
+
     mkdir_help = "create folder NAME within folder ID, only if NAME does not exist yet, returns ID of created or found folder"
     group.add_argument("--mkdir",               dest="mkdir",               help=mkdir_help,                            nargs=2,    metavar=("ID", "NAME"))
 
@@ -43,12 +84,19 @@ if __name__ == "__main__":
 
     group.add_argument("--pdf",                 dest="pdf",                 help="download file ID as pdf file NAME",   nargs=2,    metavar=("ID", "NAME"))
 
-    group.add_argument("--download",            dest="download",            help="download file ID as file NAME",       nargs=2,    metavar=("ID", "NAME"))
+    download_help = "download file ID as file NAME, by ranges fetched concurrently, interrupted download is resumed by the next run"
+    group.add_argument("--download",            dest="download",            help=download_help,                         nargs=2,    metavar=("ID", "NAME"))
 
-    upload_help = "upload local FILE as NAME to google drive folder CD, only if it does not exist yet, returns ID of created file if created"
+    download_many_help = "download files defined by JSON (e.g. '{\"ID1\": \"NAME1\", \"ID2\": \"NAME2\"}') concurrently, returns 'id ok' or 'id error' per file"
+    group.add_argument("--download-many",       dest="download_many",       help=download_many_help,                    nargs=1,    metavar=("JSON"))
+
+    pdf_many_help = "download files defined by JSON (e.g. '{\"ID1\": \"NAME1\", \"ID2\": \"NAME2\"}') as pdf files concurrently, returns 'id ok' or 'id error' per file"
+    group.add_argument("--pdf-many",            dest="pdf_many",            help=pdf_many_help,                         nargs=1,    metavar=("JSON"))
+
+    upload_help = "upload local FILE as NAME to google drive folder CD, only if it does not exist yet, returns ID of created file if created, interrupted upload is resumed by the next run"
     group.add_argument("--upload",              dest="upload",              help=upload_help,                           nargs=3,    metavar=("FILE", "CD", "NAME"))
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Set logger and console debug
     if args.debug:
@@ -73,6 +121,24 @@ if __name__ == "__main__":
         else:
             imp_user = None
         
+        if args.workers:
+            workers, = args.workers
+        else:
+            workers = DRIVE_WORKERS
+
+        if args.chunk_size:
+            chunk_size, = args.chunk_size
+        else:
+            chunk_size = DRIVE_CHUNK_SIZE
+
+        def log_progress(done_bytes, total_bytes):
+            logger.info('{0} of {1} bytes transferred ({2:.0f}%)'.format(done_bytes, total_bytes, 100.0 * done_bytes / total_bytes))
+
+        if args.format:
+            output_format, = args.format
+        else:
+            output_format = "text"
+
         # Do tasks
 
         if args.ls:
@@ -81,36 +147,97 @@ if __name__ == "__main__":
 
                 cd_folder, = args.ls
 
-                items = drive_ls(SA_SECRETS_FILE, cd_folder, imp_user)
-            
-                if not items:
+                fields = ['id', 'name', 'mimeType']
+                print_header(fields, output_format)
+
+                found = False
+                for item in drive_ls_iter(SA_SECRETS_FILE, cd_folder, imp_user):
+                    found = True
+                    logger.info(print_item(item, fields, output_format))
+
+                if not found:
                     logger.info('no files found')
-                else:
-                    for item in items:
-                        print('{0} {1} {2}'.format(item['id'], item['name'], item['mimeType']))
-                        logger.info('{0} {1} {2}'.format(item['id'], item['name'], item['mimeType']))
 
             except Exception as e:
                 raise Exception('Listing {0} failed'.format(cd_folder))
 
+        if args.ls_recursive:
+
+            try:
+
+                cd_folder, = args.ls_recursive
+
+                fields = ['id', 'path', 'mimeType']
+                print_header(fields, output_format)
+
+                for item in drive_walk(SA_SECRETS_FILE, cd_folder, imp_user, workers):
+                    logger.info(print_item(item, fields, output_format))
+
+            except Exception as e:
+                raise Exception('Listing {0} recursively failed'.format(cd_folder))
+
         if args.ls_perms:
 
             try:
 
                 ls_perms_id, = args.ls_perms
 
-                items = drive_ls_perms(SA_SECRETS_FILE, ls_perms_id, imp_user)
+                fields = ['id', 'type', 'emailAddress', 'role']
+                print_header(fields, output_format)
 
-                if not items:
+                found = False
+                for item in drive_ls_perms_iter(SA_SECRETS_FILE, ls_perms_id, imp_user):
+                    found = True
+                    logger.info(print_item(item, fields, output_format))
+
+                if not found:
                     logger.info('no permissions found')
-                else:
-                    for item in items:
-                        print('{0} {1} {2} {3}'.format(item['id'], item['type'], item['emailAddress'], item['role']))
-                        logger.info('{0} {1} {2} {3}'.format(item['id'], item['type'], item['emailAddress'], item['role']))
 
             except Exception as e:
                 raise Exception('Listing permissions {0} failed'.format(ls_perms_id))
 
+        if args.ls_perms_many:
+
+            try:
+
+                json_str, = args.ls_perms_many
+
+                response = drive_ls_perms_many(SA_SECRETS_FILE, json.loads(json_str), imp_user)
+
+                fields = ['fileId', 'id', 'type', 'emailAddress', 'role']
+                print_header(fields, output_format)
+
+                failed = 0
+                for file_id, result in response.items():
+                    if 'error' in result:
+                        failed += 1
+                        logger.error('{0} {1}'.format(file_id, result['error']))
+                        continue
+                    for item in result['permissions']:
+                        item['fileId'] = file_id
+                        logger.info(print_item(item, fields, output_format))
+
+                if failed:
+                    raise Exception('{0} files failed'.format(failed))
+
+            except Exception as e:
+                raise Exception('Listing permissions {0} failed'.format(json_str))
+
+        if args.find_many:
+
+            try:
+
+                json_str, = args.find_many
+
+                response = drive_find_many(SA_SECRETS_FILE, [(in_id, name) for in_id, name in json.loads(json_str)], imp_user)
+
+                for (in_id, name), file_id in response.items():
+                    print('{0} {1} {2}'.format(in_id, name, file_id if file_id is not None else "none"))
+                    logger.info('{0} {1} {2}'.format(in_id, name, file_id))
+
+            except Exception as e:
+                raise Exception('Finding {0} failed'.format(json_str))
+
         if args.rm:
            
             try:
@@ -124,6 +251,30 @@ if __name__ == "__main__":
             except Exception as e:
                 raise Exception('Deleting {0} failed'.format(file_id))
             
+        if args.rm_many:
+
+            try:
+
+                json_str, = args.rm_many
+
+                response = drive_rm_many(SA_SECRETS_FILE, json.loads(json_str), imp_user)
+
+                failed = 0
+                for file_id, result in response.items():
+                    if 'error' in result:
+                        failed += 1
+                        print('{0} error'.format(file_id))
+                        logger.error('{0} {1}'.format(file_id, result['error']))
+                    else:
+                        print('{0} ok'.format(file_id))
+                        logger.info('{0} ok'.format(file_id))
+
+                if failed:
+                    raise Exception('{0} files failed'.format(failed))
+
+            except Exception as e:
+                raise Exception('Deleting {0} failed'.format(json_str))
+
         if args.mkdir:
             
             try:
@@ -156,7 +307,7 @@ if __name__ == "__main__":
             
                 file_id, file_name = args.pdf
                 
-                response = drive_pdf(SA_SECRETS_FILE, file_id, file_name, imp_user)
+                response = drive_pdf(SA_SECRETS_FILE, file_id, file_name, imp_user, chunk_size)
                 print(response)
                 logger.info(response)
 
@@ -169,20 +320,47 @@ if __name__ == "__main__":
             
                 file_id, file_name = args.download
                 
-                response = drive_download(SA_SECRETS_FILE, file_id, file_name, imp_user)
+                response = drive_download(SA_SECRETS_FILE, file_id, file_name, imp_user, chunk_size, workers, log_progress)
                 print(response)
                 logger.info(response)
 
             except Exception as e:
                 raise Exception('Downloading of {0} as {1} failed'.format(file_id, file_name))
 
+        if args.download_many or args.pdf_many:
+
+            try:
+
+                if args.download_many:
+                    json_str, = args.download_many
+                else:
+                    json_str, = args.pdf_many
+
+                response = drive_download_many(SA_SECRETS_FILE, list(json.loads(json_str).items()), imp_user, workers, chunk_size, pdf=bool(args.pdf_many))
+
+                failed = 0
+                for file_id, result in response.items():
+                    if 'error' in result:
+                        failed += 1
+                        print('{0} error'.format(file_id))
+                        logger.error('{0} {1}'.format(file_id, result['error']))
+                    else:
+                        print('{0} ok'.format(file_id))
+                        logger.info('{0} ok {1}'.format(file_id, result['file']))
+
+                if failed:
+                    raise Exception('{0} files failed'.format(failed))
+
+            except Exception as e:
+                raise Exception('Downloading of {0} failed'.format(json_str))
+
         if args.upload:
             
             try:
             
                 file_local, cd_id, file_name = args.upload
 
-                response = drive_upload(SA_SECRETS_FILE, file_local, cd_id, file_name, imp_user)
+                response = drive_upload(SA_SECRETS_FILE, file_local, cd_id, file_name, imp_user, chunk_size, log_progress)
                 print(response)
                 logger.info(response)
 
@@ -193,6 +371,10 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception(e)
         logger.info("Finished script with errors")
-        sys.exit(1)
+        return 1
             
     logger.info("Finished script")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
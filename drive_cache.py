@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import sqlite3
+import threading
+
+# Local SQLite store of Drive files metadata
+# Folder is cached only as a whole: after full listing it is marked as listed and answers lookups by (parent, name) without API calls
+# Store is kept current with Drive changes API, page token and last sync time are stored per account (impersonated user or "" for service account)
+
+DRIVE_CACHE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS files (account TEXT NOT NULL, id TEXT NOT NULL, parent TEXT NOT NULL, name TEXT NOT NULL, mimeType TEXT, PRIMARY KEY (account, id, parent))",
+    "CREATE INDEX IF NOT EXISTS files_parent_name ON files (account, parent, name)",
+    "CREATE TABLE IF NOT EXISTS folders (account TEXT NOT NULL, id TEXT NOT NULL, listed_at REAL NOT NULL, PRIMARY KEY (account, id))",
+    "CREATE TABLE IF NOT EXISTS state (account TEXT NOT NULL PRIMARY KEY, page_token TEXT, synced_at REAL)"
+]
+# Stores of older versions are emptied on open
+# 1 - changes of shared drives are synced, before that shared drive folders could be stale
+DRIVE_CACHE_VERSION = 1
+
+class DriveCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    # sqlite3 connections cannot be shared between threads
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db_dir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(db_dir):
+                os.makedirs(db_dir, 0o700, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in DRIVE_CACHE_SCHEMA:
+                db.execute(statement)
+            if db.execute("PRAGMA user_version").fetchone()[0] < DRIVE_CACHE_VERSION:
+                for table in ["files", "folders", "state"]:
+                    db.execute("DELETE FROM {0}".format(table))
+                db.execute("PRAGMA user_version = {0}".format(DRIVE_CACHE_VERSION))
+            db.commit()
+            self.local.db = db
+        return db
+
+    # Sync state
+
+    def page_token(self, account):
+        row = self._db().execute("SELECT page_token FROM state WHERE account = ?", (account,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def sync_due(self, account, interval):
+        row = self._db().execute("SELECT synced_at FROM state WHERE account = ?", (account,)).fetchone()
+        return row is None or row[0] is None or time.time() - row[0] >= interval
+
+    def synced(self, account, page_token):
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO state (account, page_token, synced_at) VALUES (?, ?, ?)", (account, page_token, time.time()))
+
+    # Forget everything known for account, e.g. when page token is not accepted anymore
+    def reset(self, account):
+        with self._db() as db:
+            db.execute("DELETE FROM files WHERE account = ?", (account,))
+            db.execute("DELETE FROM folders WHERE account = ?", (account,))
+            db.execute("DELETE FROM state WHERE account = ?", (account,))
+
+    # Changes are dicts from changes().list with fields fileId, removed, file(id, name, mimeType, parents)
+    # Only files within listed folders are stored, everything else will be listed when needed
+    def apply_changes(self, account, changes):
+        with self._db() as db:
+            for change in changes:
+                db.execute("DELETE FROM files WHERE account = ? AND id = ?", (account, change['fileId']))
+                if change.get('removed') or 'file' not in change:
+                    db.execute("DELETE FROM files WHERE account = ? AND parent = ?", (account, change['fileId']))
+                    db.execute("DELETE FROM folders WHERE account = ? AND id = ?", (account, change['fileId']))
+                    continue
+                item = change['file']
+                for parent in item.get('parents', []):
+                    if db.execute("SELECT 1 FROM folders WHERE account = ? AND id = ?", (account, parent)).fetchone() is not None:
+                        db.execute("INSERT OR REPLACE INTO files (account, id, parent, name, mimeType) VALUES (?, ?, ?, ?, ?)", (account, item['id'], parent, item['name'], item.get('mimeType')))
+
+    # Folders
+
+    def folder_listed(self, account, folder_id):
+        return self._db().execute("SELECT 1 FROM folders WHERE account = ? AND id = ?", (account, folder_id)).fetchone() is not None
+
+    # Returns list of {'id', 'name', 'mimeType'} or None if folder was not listed yet
+    def folder_items(self, account, folder_id):
+        if not self.folder_listed(account, folder_id):
+            return None
+        rows = self._db().execute("SELECT id, name, mimeType FROM files WHERE account = ? AND parent = ? ORDER BY rowid", (account, folder_id)).fetchall()
+        return [{'id': row[0], 'name': row[1], 'mimeType': row[2]} for row in rows]
+
+    def set_folder_items(self, account, folder_id, items):
+        with self._db() as db:
+            db.execute("DELETE FROM files WHERE account = ? AND parent = ?", (account, folder_id))
+            db.executemany("INSERT OR REPLACE INTO files (account, id, parent, name, mimeType) VALUES (?, ?, ?, ?, ?)", [(account, item['id'], folder_id, item['name'], item.get('mimeType')) for item in items])
+            db.execute("INSERT OR REPLACE INTO folders (account, id, listed_at) VALUES (?, ?, ?)", (account, folder_id, time.time()))
+
+    # Files
+
+    # Returns ID of the first file named name within listed folder parent, None if there is no such file
+    def find(self, account, parent, name):
+        row = self._db().execute("SELECT id FROM files WHERE account = ? AND parent = ? AND name = ? ORDER BY rowid LIMIT 1", (account, parent, name)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add(self, account, file_id, parent, name, mime_type):
+        if not self.folder_listed(account, parent):
+            return
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO files (account, id, parent, name, mimeType) VALUES (?, ?, ?, ?, ?)", (account, file_id, parent, name, mime_type))
+
+    def remove(self, account, file_id):
+        with self._db() as db:
+            db.execute("DELETE FROM files WHERE account = ? AND id = ?", (account, file_id))
+            db.execute("DELETE FROM files WHERE account = ? AND parent = ?", (account, file_id))
+            db.execute("DELETE FROM folders WHERE account = ? AND id = ?", (account, file_id))
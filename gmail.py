@@ -4,6 +4,7 @@
 # Import common code
 from sysadmws_common import *
 from gsuite_scripts import *
+import csv
 
 # Constants
 LOGO="G Suite Scripts / Gmail"
@@ -12,23 +13,57 @@ if LOG_DIR is None:
     LOG_DIR = "log"
 LOG_FILE = "gmail.log"
 SA_SECRETS_FILE = os.environ.get("SA_SECRETS_FILE")
+OUTPUT_FORMATS = ["text", "jsonl"]
+
+# Draft rows are read from CSV with header (by .csv extension) or JSON Lines file, numbered from 1
+def drafts_rows(drafts_file):
+
+    with open(drafts_file, "r", newline="", encoding="utf-8") as f:
+        if drafts_file.endswith(".csv"):
+            for row_n, row in enumerate(csv.DictReader(f), 1):
+                yield row_n, row
+        else:
+            row_n = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                row_n += 1
+                yield row_n, json.loads(line)
 
 # Main
 
-if __name__ == "__main__":
+def main(argv=None):
 
     # Set parser and parse args
     parser = argparse.ArgumentParser(description='Script to automate specific operations with Gmail.')
     parser.add_argument("--debug",              dest="debug",               help="enable debug",                        action="store_true")
+    query_help = "list only messages matching gmail search QUERY (e.g. 'from:a@example.com newer_than:7d')"
+    parser.add_argument("--query",              dest="query",               help=query_help,                            nargs=1,    metavar=("QUERY"))
+    label_help = "list only messages with label ID LABEL (e.g. INBOX), could be repeated"
+    parser.add_argument("--label",              dest="label",               help=label_help,                            nargs=1,    metavar=("LABEL"),  action="append")
+    format_help = "output format of listings: text (default, message ids and snippets) or jsonl (message metadata)"
+    parser.add_argument("--format",             dest="format",              help=format_help,                           nargs=1,    metavar=("FORMAT"), choices=OUTPUT_FORMATS)
+    workers_help = "fetch message metadata with up to N concurrent batch requests, {0} by default, or create up to N drafts concurrently, {1} by default".format(GMAIL_WORKERS, GMAIL_DRAFTS_WORKERS)
+    parser.add_argument("--workers",            dest="workers",             help=workers_help,                          nargs=1,    metavar=("N"),      type=int)
+    user_workers_help = "create up to N drafts concurrently for the same gmail user, {0} by default".format(GMAIL_DRAFTS_USER_WORKERS)
+    parser.add_argument("--user-workers",       dest="user_workers",        help=user_workers_help,                     nargs=1,    metavar=("N"),      type=int,   default=[GMAIL_DRAFTS_USER_WORKERS])
+    parser.add_argument("--send",               dest="send",                help="send drafts created by --create-drafts", action="store_true")
+    result_help = "append result JSON line of every draft row to FILE and skip rows done according to it, to restart interrupted --create-drafts"
+    parser.add_argument("--result",             dest="result",              help=result_help,                           nargs=1,    metavar=("FILE"))
     group = parser.add_mutually_exclusive_group(required=True)
     create_draft_help = """create draft inside USER gmail, from email FROM to email(s) TO, CC, BCC with SUBJECT and TEXT, and attach local files listed with json list ATTACH,
                            e.g. --create-draft me@example.com '"Me Myself" <me@example.com>' '"Client 1" <client1@acme.com>, "Client 2" <client2@acme.com>' '"Someone Other" cc@acme.com' 'bcc@acme.com' 'Subject may contain UTF - перевірка チェックする' 'Message may contain UTF and new\\nlines\\nперевірка\\nチェックする' '["a.pdf", "b.pdf"]'"""
     group.add_argument("--create-draft",        dest="create_draft",        help=create_draft_help,                     nargs=8,    metavar=("USER", "FROM", "TO", "CC", "BCC", "SUBJECT", "TEXT", "ATTACH"))
+    create_drafts_help = """create drafts of every row of CSV (by .csv extension) or JSON Lines FILE with fields user, from, to, cc, bcc, subject, text and attach (JSON list of local files),
+                            cc, bcc and attach are optional, rows with draft_id field are only sent, result of every row is printed as JSON line"""
+    group.add_argument("--create-drafts",       dest="create_drafts",       help=create_drafts_help,                    nargs=1,    metavar=("FILE"))
     send_draft_help = "send draft DRAFT_ID inside USER gmail"
     group.add_argument("--send-draft",          dest="send_draft",          help=send_draft_help,                       nargs=2,    metavar=("USER", "DRAFT_ID"))
-    list_messages_help = "list messages available to gmail USER"
+    list_messages_help = "list all messages available to gmail USER, as they are fetched"
     group.add_argument("--list-messages",       dest="list_messages",       help=list_messages_help,                    nargs=1,    metavar=("USER"))
-    args = parser.parse_args()
+    sync_messages_help = "print changes of gmail USER mailbox since the previous sync as JSON lines (added with message metadata, deleted, or resync followed by all messages), last history ID per user is kept in {0}".format(GMAIL_STATE_DIR)
+    group.add_argument("--sync-messages",       dest="sync_messages",       help=sync_messages_help,                    nargs=1,    metavar=("USER"))
+    args = parser.parse_args(argv)
 
     # Set logger and console debug
     if args.debug:
@@ -63,21 +98,102 @@ if __name__ == "__main__":
             except Exception as e:
                 raise Exception('Creating draft for user {0} failed'.format(gmail_user))
             
+        if args.create_drafts:
+
+            try:
+
+                # Rows are independent, failed row does not stop others
+                # Rows created or sent by previous runs with the same result file are skipped, created but not sent drafts are only sent with --send
+
+                drafts_file, = args.create_drafts
+                workers = args.workers[0] if args.workers else GMAIL_DRAFTS_WORKERS
+                user_workers, = args.user_workers
+                result_file = args.result[0] if args.result else None
+                results = batch_status_load(result_file, 'row')
+                failed = 0
+                total = 0
+
+                def rows():
+                    nonlocal total
+                    for row_n, row in drafts_rows(drafts_file):
+                        previous = results.get(row_n, {})
+                        if previous.get('status') == "sent" or (previous.get('status') == "created" and not args.send):
+                            continue
+                        if previous.get('draft') and not row.get('draft_id'):
+                            row['draft_id'] = previous['draft']
+                        total += 1
+                        yield row_n, row
+
+                result_out = None
+                if result_file is not None:
+                    result_out = open(result_file, "a", encoding="utf-8")
+
+                try:
+
+                    for row_n, result in gmail_drafts_many(SA_SECRETS_FILE, rows(), args.send, workers, user_workers):
+                        result = dict(row=row_n, **result)
+                        if result['status'] == "failed":
+                            logger.error('Row {0} failed: {1}'.format(row_n, result['error']))
+                            failed += 1
+                        line = json.dumps(result)
+                        print(line, flush=True)
+                        logger.info(line)
+                        if result_out is not None:
+                            result_out.write(line + "\n")
+                            result_out.flush()
+
+                finally:
+                    if result_out is not None:
+                        result_out.close()
+
+                if failed:
+                    raise Exception('{0} of {1} draft rows failed'.format(failed, total))
+
+            except Exception as e:
+                raise Exception('Creating drafts from {0} failed'.format(drafts_file))
+
         if args.list_messages:
             
             try:
             
                 gmail_user, = args.list_messages
 
-                response = gmail_list_messages(SA_SECRETS_FILE, gmail_user)
-
-                for item in response:
-                    print(item)
-                    logger.info(item)
+                query = args.query[0] if args.query else None
+                label_ids = [label for label, in args.label] if args.label else None
+                workers = args.workers[0] if args.workers else GMAIL_WORKERS
+                output_format = args.format[0] if args.format else "text"
+
+                for item in gmail_iter_messages(SA_SECRETS_FILE, gmail_user, query, label_ids, workers):
+                    if output_format == "jsonl":
+                        line = json.dumps(item)
+                        print(line, flush=True)
+                        logger.info(line)
+                    else:
+                        msg = {'id': item['id'], 'threadId': item['threadId']}
+                        print(msg)
+                        print(item['snippet'], flush=True)
+                        logger.info(msg)
+                        logger.info(item['snippet'])
 
             except Exception as e:
                 raise Exception('Listing messages for user {0} failed'.format(gmail_user))
             
+        if args.sync_messages:
+
+            try:
+
+                gmail_user, = args.sync_messages
+
+                workers = args.workers[0] if args.workers else GMAIL_WORKERS
+
+                for item in gmail_sync_messages(SA_SECRETS_FILE, gmail_user, workers=workers):
+                    line = json.dumps(item)
+                    print(line, flush=True)
+                    logger.info(line)
+
+            except Exception as e:
+                raise Exception('Syncing messages for user {0} failed'.format(gmail_user))
+
         if args.send_draft:
             
             try:
@@ -96,6 +212,10 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception(e)
         logger.info("Finished script with errors")
-        sys.exit(1)
+        return 1
             
     logger.info("Finished script")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
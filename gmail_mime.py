@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import uuid
+import base64
+import hashlib
+import threading
+import collections
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+
+# MIME message written to file with attachments streamed from disk
+# Message is built by email package with a placeholder token as payload of every attachment,
+# then written with tokens replaced by base64 of attachment files read by chunks, so no attachment is held in memory
+
+# Multiple of 57 bytes, which are encoded to one 76 characters line
+GMAIL_MIME_READ_SIZE = 57 * 1024
+
+# Attachments encoded to base64 lines, kept in memory up to max_bytes and evicted least recently used first
+# Files are looked up by real path, size and modification time, so unchanged file is neither read nor encoded again,
+# and encoded parts are stored by sha256 of file content, so the same content under other names is kept and encoded once
+# Files larger than a quarter of max_bytes are not cached, they are streamed every time
+class GmailAttachmentCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.files = {}
+        self.parts = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Returns encoded file or None if file is too large to cache
+    def encoded(self, file_name):
+
+        stat = os.stat(file_name)
+        file_key = (os.path.realpath(file_name), stat.st_size, stat.st_mtime_ns)
+
+        # base64 lines take 4/3 of file plus new line per 57 bytes
+        if (stat.st_size + 2) // 3 * 4 + stat.st_size // 57 + 1 > self.max_bytes // 4:
+            return None
+
+        with self.lock:
+            digest = self.files.get(file_key)
+            if digest is not None and digest in self.parts:
+                self.parts.move_to_end(digest)
+                self.hits += 1
+                return self.parts[digest]
+
+        with open(file_name, "rb") as attachment:
+            content = attachment.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        with self.lock:
+            self.files[file_key] = digest
+            if digest in self.parts:
+                self.parts.move_to_end(digest)
+                self.hits += 1
+                return self.parts[digest]
+
+        # Encoded outside of lock, concurrent misses of the same file encode it twice, which is harmless
+        part = base64.encodebytes(content)
+
+        with self.lock:
+            self.misses += 1
+            if digest not in self.parts:
+                self.parts[digest] = part
+                self.size += len(part)
+            while self.size > self.max_bytes:
+                evicted_digest, evicted_part = self.parts.popitem(last=False)
+                self.size -= len(evicted_part)
+            # Path keys of evicted parts are dropped too, so that files do not grow with every changed file
+            if len(self.files) > 2 * len(self.parts) + 1024:
+                self.files = dict((key, value) for key, value in self.files.items() if value in self.parts)
+
+        return part
+
+def gmail_mime_message(message_from, message_to, message_cc, message_bcc, message_subject, message_text):
+
+    message = MIMEMultipart()
+    message['From'] = message_from
+    message['To'] = message_to
+    message['Cc'] = message_cc
+    message['Bcc'] = message_bcc
+    message['Subject'] = message_subject
+
+    message.attach(MIMEText(message_text, "plain"))
+
+    return message
+
+# Writes base64 of file with 76 characters lines, from cache if it is given
+def gmail_mime_write_base64(out_file, file_name, attach_cache=None):
+
+    if attach_cache is not None:
+        part = attach_cache.encoded(file_name)
+        if part is not None:
+            out_file.write(part)
+            return
+
+    with open(file_name, "rb") as attachment:
+        while True:
+            chunk = attachment.read(GMAIL_MIME_READ_SIZE)
+            if not chunk:
+                break
+            out_file.write(base64.encodebytes(chunk))
+
+def gmail_mime_write(out_file, message_from, message_to, message_cc, message_bcc, message_subject, message_text, attach_list, attach_cache=None):
+
+    message = gmail_mime_message(message_from, message_to, message_cc, message_bcc, message_subject, message_text)
+
+    tokens = {}
+
+    for file_name in attach_list:
+
+        # Fail before anything is written if file is missing
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError("Attachment {0} not found".format(file_name))
+
+        token = "GSUITE-ATTACHMENT-{0}".format(uuid.uuid4().hex).encode("ascii")
+        tokens[token] = file_name
+
+        part = MIMEBase("application", "octet-stream")
+        part['Content-Transfer-Encoding'] = "base64"
+        part.set_payload(token.decode("ascii"))
+        part.add_header("Content-Disposition", "attachment", filename=os.path.basename(file_name))
+        message.attach(part)
+
+    skeleton = message.as_bytes()
+
+    position = 0
+    for token in tokens:
+        token_start = skeleton.index(token, position)
+        out_file.write(skeleton[position:token_start])
+        gmail_mime_write_base64(out_file, tokens[token], attach_cache)
+        position = token_start + len(token)
+        # Encoded attachment already ends with new line
+        if skeleton[position:position + 1] == b"\n":
+            position += 1
+
+    out_file.write(skeleton[position:])
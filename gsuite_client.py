@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Thin client for gsuite_daemon.py
+# Only standard library is imported here, so forwarding a command line costs just interpreter startup
+import os
+import sys
+import json
+import socket
+
+# Constants
+DAEMON_SOCKET = os.environ.get("GSUITE_DAEMON_SOCKET")
+if DAEMON_SOCKET is None:
+    DAEMON_SOCKET = "/tmp/gsuite-scripts-{0}.sock".format(os.getuid())
+DAEMON_SCRIPTS = ["drive", "docs", "sheets", "gmail", "batch", "merge"]
+# Envs read by scripts at import, daemon sets them on script module for every command
+DAEMON_SCRIPT_ENV = ["SA_SECRETS_FILE", "LOG_DIR"]
+# Envs read by gsuite_scripts at import into process wide state, command runs in daemon only if client has the same values
+DAEMON_PROCESS_ENV = ["GSUITE_CACHE_DIR", "GSUITE_RATE_LIMITS", "DRIVE_CACHE_FILE", "SHEETS_SPOOL_DIR", "GMAIL_MIME_DIR", "GMAIL_ATTACHMENT_CACHE_BYTES"]
+
+# Protocol is one JSON line request per connection, answered by JSON line frames:
+# {"stdout": text} and {"stderr": text} as script prints, then either {"exit": code} or {"fallback": reason} if client should run the script itself
+
+def daemon_connect(socket_path=DAEMON_SOCKET):
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(socket_path)
+    except:
+        sock.close()
+        raise
+
+    return sock
+
+def daemon_call(sock, script, argv, cwd, env):
+
+    try:
+
+        request = {
+            'script': script,
+            'argv': argv,
+            'cwd': cwd,
+            'env': env
+        }
+
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+        with sock.makefile("rb") as sock_file:
+            for frame_line in sock_file:
+                frame = json.loads(frame_line.decode("utf-8"))
+                if 'stdout' in frame:
+                    sys.stdout.write(frame['stdout'])
+                    sys.stdout.flush()
+                elif 'stderr' in frame:
+                    sys.stderr.write(frame['stderr'])
+                    sys.stderr.flush()
+                else:
+                    return frame
+
+        raise ConnectionError("Daemon closed connection without exit code")
+
+    finally:
+        sock.close()
+
+def run_script(script, argv):
+
+    script_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "{0}.py".format(script))
+    os.execv(sys.executable, [sys.executable, script_file] + argv)
+
+# Main
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1].replace(".py", "") not in DAEMON_SCRIPTS:
+        sys.stderr.write("usage: gsuite_client.py {{{0}}} [script args ...]\n".format(",".join(DAEMON_SCRIPTS)))
+        sys.exit(2)
+
+    script = sys.argv[1].replace(".py", "")
+    argv = sys.argv[2:]
+
+    # Run the script in this process if daemon is not running
+    try:
+        sock = daemon_connect()
+    except OSError:
+        run_script(script, argv)
+
+    env = dict((name, os.environ.get(name)) for name in DAEMON_SCRIPT_ENV + DAEMON_PROCESS_ENV)
+
+    response = daemon_call(sock, script, argv, os.getcwd(), env)
+
+    # Daemon was started with other envs, which cannot be changed per command, or is running other command
+    if 'fallback' in response:
+        run_script(script, argv)
+
+    sys.exit(response['exit'])
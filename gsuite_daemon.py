@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Import common code
+from sysadmws_common import *
+from gsuite_client import DAEMON_SOCKET, DAEMON_SCRIPT_ENV, DAEMON_PROCESS_ENV
+import io
+import threading
+import stat
+import socketserver
+import contextlib
+import traceback
+import drive
+import docs
+import sheets
+import gmail
+import batch
+import merge
+
+# Constants
+LOGO="G Suite Scripts / Daemon"
+LOG_DIR = os.environ.get("LOG_DIR")
+if LOG_DIR is None:
+    LOG_DIR = "log"
+LOG_FILE = "daemon.log"
+DAEMON_SCRIPTS = {
+    'drive': drive,
+    'docs': docs,
+    'sheets': sheets,
+    'gmail': gmail,
+    'batch': batch,
+    'merge': merge
+}
+# Options which never return, they would block all other clients
+DAEMON_REJECTED_OPTIONS = {
+    'sheets': ["--watch"]
+}
+# Held while a command runs
+DAEMON_COMMAND_LOCK = threading.Lock()
+
+# Commands are run one by one: scripts print to sys.stdout and work relative to the client cwd, both are process wide
+# Connections are accepted by threads, client which comes while a command is running gets fallback and runs the script itself,
+# so a long command (e.g. merge or --ls-recursive) does not hold other clients in queue
+# Output is sent to client line by line as it is printed, so streaming commands stay streaming and output is not held in memory
+# API clients, credentials and discovery documents stay cached in gsuite_scripts between requests
+
+# Frames of one connection, shared by stdout and stderr writers and script threads
+class DaemonChannel(object):
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.broken = False
+
+    # Client went away: the first failed send raises, so that script stops, later frames are dropped
+    def send(self, frame):
+
+        with self.lock:
+            if self.broken:
+                return
+            try:
+                self.wfile.write(json.dumps(frame).encode("utf-8") + b"\n")
+            except OSError:
+                self.broken = True
+                raise
+
+class DaemonFrameWriter(io.TextIOBase):
+
+    def __init__(self, channel, stream):
+        self.channel = channel
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            self.pending += text
+            if "\n" not in text:
+                return len(text)
+            pending, self.pending = self.pending, ""
+        self.channel.send({self.stream: pending})
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, ""
+        if pending:
+            self.channel.send({self.stream: pending})
+
+def daemon_option_rejected(script, argv):
+
+    for arg in argv:
+        option = arg.split("=", 1)[0]
+        # argparse accepts unique prefixes of options
+        for rejected in DAEMON_REJECTED_OPTIONS.get(script, []):
+            if len(option) > 2 and rejected.startswith(option):
+                return rejected
+
+    return None
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        request_line = self.rfile.readline()
+        if not request_line:
+            return
+
+        channel = DaemonChannel(self.wfile)
+
+        try:
+            request = json.loads(request_line.decode("utf-8"))
+            script = request['script']
+            argv = request['argv']
+            env = request.get('env', {})
+        except Exception as e:
+            channel.send({'stderr': "Invalid request: {0}\n".format(e)})
+            channel.send({'exit': 1})
+            return
+
+        if script not in DAEMON_SCRIPTS:
+            channel.send({'stderr': "Unknown script {0}\n".format(script)})
+            channel.send({'exit': 1})
+            return
+
+        rejected = daemon_option_rejected(script, argv)
+        if rejected is not None:
+            channel.send({'stderr': "{0}.py {1} is not supported in daemon mode, run {0}.py directly\n".format(script, rejected)})
+            channel.send({'exit': 2})
+            return
+
+        changed = [name for name in DAEMON_PROCESS_ENV if env.get(name) != os.environ.get(name)]
+        if changed:
+            self.server.logger.info("Client envs {0} differ from daemon, client runs {1} itself".format(", ".join(changed), script))
+            channel.send({'fallback': "Envs {0} differ from daemon".format(", ".join(changed))})
+            return
+
+        if not DAEMON_COMMAND_LOCK.acquire(blocking=False):
+            self.server.logger.info("Daemon is busy, client runs {0} itself".format(script))
+            channel.send({'fallback': "Daemon is busy"})
+            return
+
+        stdout = DaemonFrameWriter(channel, "stdout")
+        stderr = DaemonFrameWriter(channel, "stderr")
+
+        try:
+            exit_code = self.run_command(stdout, stderr, script, argv, request['cwd'], env)
+        finally:
+            DAEMON_COMMAND_LOCK.release()
+
+        try:
+            stdout.flush()
+            stderr.flush()
+            channel.send({'exit': exit_code})
+        except OSError:
+            self.server.logger.info("Client of {0} {1} went away".format(script, argv))
+
+    def run_command(self, stdout, stderr, script, argv, cwd, env):
+
+        module = DAEMON_SCRIPTS[script]
+        daemon_cwd = os.getcwd()
+        daemon_argv0 = sys.argv[0]
+        daemon_env = dict((name, getattr(module, name)) for name in DAEMON_SCRIPT_ENV)
+
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+
+            try:
+
+                self.server.logger.info("Running {0} {1}".format(script, argv))
+
+                # Scripts read these envs at import, so they are set on module, with the same defaults
+                module.SA_SECRETS_FILE = env.get("SA_SECRETS_FILE")
+                module.LOG_DIR = env.get("LOG_DIR") or "log"
+
+                # argparse takes usage prog name from sys.argv[0]
+                sys.argv[0] = "{0}.py".format(script)
+                os.chdir(cwd)
+                exit_code = module.main(argv)
+
+            # argparse exits on --help and usage errors
+            except SystemExit as e:
+                if e.code is None:
+                    exit_code = 0
+                elif isinstance(e.code, int):
+                    exit_code = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    exit_code = 1
+
+            except Exception as e:
+                traceback.print_exc()
+                exit_code = 1
+
+            finally:
+                for name in daemon_env:
+                    setattr(module, name, daemon_env[name])
+                sys.argv[0] = daemon_argv0
+                os.chdir(daemon_cwd)
+
+        return exit_code
+
+# Main
+
+if __name__ == "__main__":
+
+    # Set parser and parse args
+    parser = argparse.ArgumentParser(description='Resident server running drive.py, docs.py, sheets.py, gmail.py and batch.py commands sent by gsuite_client.py.')
+    parser.add_argument("--debug",              dest="debug",               help="enable debug",                        action="store_true")
+    socket_help = "listen on unix socket SOCKET, GSUITE_DAEMON_SOCKET env or /tmp/gsuite-scripts-UID.sock by default"
+    parser.add_argument("--socket",             dest="socket",              help=socket_help,                           nargs=1,    metavar=("SOCKET"))
+    args = parser.parse_args()
+
+    # Set logger and console debug
+    if args.debug:
+        logger = set_logger(logging.DEBUG, LOG_DIR, LOG_FILE, logger_name="gsuite_daemon")
+    else:
+        logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE, logger_name="gsuite_daemon")
+
+    # Catch exception to logger
+
+    try:
+
+        logger.info(LOGO)
+        logger.info("Starting daemon")
+
+        if args.socket:
+            socket_path, = args.socket
+        else:
+            socket_path = DAEMON_SOCKET
+
+        # Remove stale socket left by killed daemon
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise Exception("{0} exists and is not a socket".format(socket_path))
+            os.unlink(socket_path)
+
+        # Socket gives access to the service account, allow only the owner to connect
+        old_umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler)
+        finally:
+            os.umask(old_umask)
+        server.daemon_threads = True
+        server.logger = logger
+
+        logger.info("Listening on {0}".format(socket_path))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+
+    # Reroute catched exception to log
+    except Exception as e:
+        logger.exception(e)
+        logger.info("Finished daemon with errors")
+        sys.exit(1)
+
+    logger.info("Finished daemon")
@@ -6,6 +6,7 @@ from google.oauth2 import service_account
 import io
 from apiclient.http import MediaIoBaseDownload
 from apiclient.http import MediaFileUpload
+from googleapiclient.http import HttpRequest
 import base64
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -13,10 +14,100 @@ from email.mime.base import MIMEBase
 import mimetypes
 from email import encoders
 import string
-from retrying import retry
+import threading
+import hashlib
+import tempfile
+from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import random
+import socket
+import functools
+import http.client
+import httplib2
+from drive_cache import DriveCache
+from docs_model import DocsDocument, DOCS_MODEL_FIELDS
+from sheets_spool import SheetsSpool, sheets_values_rows
+from sheets_columns import SHEETS_COLUMNS_FORMATS, SHEETS_DATE_FORMAT_TYPES, sheets_columns_from_rows, sheets_columns_write
+from a1 import A1Range, a1_parse, a1_format, a1_sheet, a1_width, a1_height, a1_pad_rows
+from gmail_mime import GmailAttachmentCache, gmail_mime_message, gmail_mime_write
+from docs_requests import docs_replace_all_text_requests, docs_insert_table_rows_requests, docs_delete_table_row_requests, docs_insert_empty_table_rows_requests, docs_fill_table_cells_requests, docs_requests_chunks
 
 # Constants
-GSUITE_RETRIES = 3
+GSUITE_RETRIES = 5
+GSUITE_BACKOFF_BASE = 1
+GSUITE_BACKOFF_MAX = 64
+# Requests (quota units for gmail) per second and burst per API within process, could be overridden with GSUITE_RATE_LIMITS env, e.g. '{"docs.write": [0.5, 2]}'
+# Docs and sheets have separate per user quotas of reads and writes per minute: docs 300 reads and 60 writes, sheets 60 reads and 60 writes,
+# bursts are kept small so that a minute does not go much over its quota
+GSUITE_RATE_LIMITS = {
+    'drive': [10, 20],
+    'docs.read': [5, 10],
+    'docs.write': [1, 5],
+    'sheets.read': [1, 5],
+    'sheets.write': [1, 5],
+    'gmail': [250, 250]
+}
+# Limits of these APIs are kept separately for read and write methods, limit given for the whole API (e.g. "docs") sets both
+GSUITE_READ_WRITE_APIS = ['docs', 'sheets']
+GSUITE_READ_METHODS = ['get', 'batchGet', 'getByDataFilter', 'batchGetByDataFilter']
+if os.environ.get("GSUITE_RATE_LIMITS") is not None:
+    for rate_api, rate_limit in json.loads(os.environ.get("GSUITE_RATE_LIMITS")).items():
+        if rate_api in GSUITE_READ_WRITE_APIS:
+            GSUITE_RATE_LIMITS["{0}.read".format(rate_api)] = rate_limit
+            GSUITE_RATE_LIMITS["{0}.write".format(rate_api)] = rate_limit
+        else:
+            GSUITE_RATE_LIMITS[rate_api] = rate_limit
+# Limits of these APIs are quota units per second per delegated user
+GSUITE_PER_USER_APIS = ['gmail']
+GMAIL_QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.drafts.create': 10,
+    'gmail.users.drafts.send': 100,
+    'gmail.users.messages.send': 100
+}
+GMAIL_QUOTA_UNITS_DEFAULT = 5
+GSUITE_RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError', 'internalError']
+GSUITE_CACHE_DIR = os.environ.get("GSUITE_CACHE_DIR")
+if GSUITE_CACHE_DIR is None:
+    GSUITE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gsuite-scripts")
+DISCOVERY_CACHE_MAX_AGE = 86400
+BATCH_SIZE = 100
+DRIVE_PAGE_SIZE = 1000
+DRIVE_WORKERS = 8
+DRIVE_FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+DRIVE_CACHE_FILE = os.environ.get("DRIVE_CACHE_FILE")
+DRIVE_CACHE_SYNC_INTERVAL = 60
+DRIVE_CHUNK_SIZE = 10 * 1024 * 1024
+DRIVE_CHUNK_SIZE_UNIT = 256 * 1024
+DRIVE_UPLOADS_DIR = os.path.join(GSUITE_CACHE_DIR, "uploads")
+BATCH_PART_NAME = "{0}.part"
+DOCS_BATCH_MAX_REQUESTS = 500
+DOCS_BATCH_MAX_BYTES = 512 * 1024
+SHEETS_WINDOW_ROWS = 10000
+SHEETS_APPEND_MAX_ROWS = 5000
+SHEETS_APPEND_MAX_AGE = 10
+GMAIL_PAGE_SIZE = 500
+GMAIL_BATCH_SIZE = 50
+GMAIL_WORKERS = 4
+GMAIL_METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+GMAIL_METADATA_FIELDS = "id,threadId,labelIds,snippet,internalDate,sizeEstimate,payload/headers"
+GMAIL_STATE_DIR = os.path.join(GSUITE_CACHE_DIR, "gmail")
+GMAIL_DRAFTS_WORKERS = 8
+GMAIL_DRAFTS_USER_WORKERS = 4
+GMAIL_DRAFTS_READ_AHEAD = 1000
+GMAIL_ATTACHMENT_CACHE_BYTES = int(os.environ.get("GMAIL_ATTACHMENT_CACHE_BYTES", 64 * 1024 * 1024))
+GMAIL_MIME_DIR = os.environ.get("GMAIL_MIME_DIR")
+if GMAIL_MIME_DIR is None:
+    GMAIL_MIME_DIR = os.path.join(GSUITE_CACHE_DIR, "gmail-mime")
+GMAIL_UPLOAD_CHUNK_SIZE = 10 * 1024 * 1024
+SHEETS_SPOOL_DIR = os.environ.get("SHEETS_SPOOL_DIR")
+if SHEETS_SPOOL_DIR is None:
+    SHEETS_SPOOL_DIR = os.path.join(GSUITE_CACHE_DIR, "sheets-spool")
 DOCS_SCOPES = ['https://www.googleapis.com/auth/documents']
 DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
 SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
@@ -28,13 +119,368 @@ GMAIL_SCOPES = [
     'https://www.googleapis.com/auth/gmail.send'
 ]
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
+# Rate limiting and retries
+# Every request takes tokens from its API bucket, so concurrent threads do not exceed quotas
+# Gmail quota is per user and in quota units, which differ by method, so Gmail buckets are per delegated user and methods take their units
+# When API throttles anyway, bucket rate is halved and then restored gradually with successful requests
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # More tokens than burst are taken by burst sized slices, so large batches wait for all their tokens
+    def acquire(self, tokens=1):
+        while tokens > 0:
+            slice_tokens = min(tokens, self.burst)
+            self._acquire(slice_tokens)
+            tokens -= slice_tokens
+
+    def _acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = 0.0
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+_RATE_BUCKETS = {}
+_RATE_BUCKETS_LOCK = threading.Lock()
+
+# Returns bucket of API (and user for per user APIs) or None if API is not limited
+def gsuite_rate_bucket(api, user=None):
+
+    if api not in GSUITE_RATE_LIMITS:
+        return None
+
+    key = (api, user if api in GSUITE_PER_USER_APIS else None)
+
+    with _RATE_BUCKETS_LOCK:
+        bucket = _RATE_BUCKETS.get(key)
+        if bucket is None:
+            rate, burst = GSUITE_RATE_LIMITS[api]
+            bucket = TokenBucket(rate, burst)
+            _RATE_BUCKETS[key] = bucket
+
+    return bucket
+
+def gsuite_rate_limit(api, tokens=1, user=None):
+    bucket = gsuite_rate_bucket(api, user)
+    if bucket is not None:
+        bucket.acquire(tokens)
+
+# Delegated user of request is subject of its credentials, reads and writes of docs and sheets have separate buckets
+def gsuite_request_bucket(request):
+    api = request.methodId.split(".")[0]
+    if api in GSUITE_READ_WRITE_APIS:
+        if request.methodId.split(".")[-1] in GSUITE_READ_METHODS:
+            api = "{0}.read".format(api)
+        else:
+            api = "{0}.write".format(api)
+    credentials = getattr(request.http, "credentials", None)
+    return gsuite_rate_bucket(api, getattr(credentials, "_subject", None))
+
+def gsuite_request_tokens(request):
+    if request.methodId.startswith("gmail."):
+        return GMAIL_QUOTA_UNITS.get(request.methodId, GMAIL_QUOTA_UNITS_DEFAULT)
+    return 1
+
+# Docs and sheets requests are all made with GsuiteHttpRequest, their bucket depends on method, which uri does not tell
+def gsuite_api_from_uri(uri):
+    if uri is None:
+        return None
+    for api in ['drive', 'gmail']:
+        if "/{0}/".format(api) in uri:
+            return api
+    return None
+
+# Returns reason of HttpError from error details, e.g. rateLimitExceeded
+def gsuite_error_reason(exception):
+    try:
+        error = json.loads(exception.content.decode("utf-8"))['error']
+        return error['errors'][0]['reason']
+    except:
+        return None
+
+def gsuite_error_throttled(exception):
+    return isinstance(exception, HttpError) and (exception.resp.status == 429 or (exception.resp.status == 403 and gsuite_error_reason(exception) in GSUITE_RATE_LIMIT_REASONS))
+
+# Only throttling, server side and network errors are worth retrying, other 4xx errors will not change
+def gsuite_error_retryable(exception):
+    if isinstance(exception, HttpError):
+        return gsuite_error_throttled(exception) or exception.resp.status >= 500
+    return isinstance(exception, (socket.timeout, ConnectionError, http.client.HTTPException, httplib2.HttpLib2Error))
+
+# Slows down bucket of throttled request, once per error
+def gsuite_throttled(exception, bucket):
+    if bucket is not None and gsuite_error_throttled(exception) and not getattr(exception, "gsuite_throttled", False):
+        bucket.throttled()
+        exception.gsuite_throttled = True
+
+# Exponential backoff with full jitter, Retry-After header is honoured if present
+def gsuite_backoff(exception, attempt):
+    delay = random.uniform(0, min(GSUITE_BACKOFF_MAX, GSUITE_BACKOFF_BASE * 2 ** attempt))
+    if isinstance(exception, HttpError):
+        try:
+            delay = max(delay, float(exception.resp.get('retry-after')))
+        except (TypeError, ValueError):
+            pass
+        # Requests made without GsuiteHttpRequest, e.g. ranged downloads, are found by uri, user of per user APIs is unknown there
+        api = gsuite_api_from_uri(exception.uri)
+        if api not in GSUITE_PER_USER_APIS:
+            gsuite_throttled(exception, gsuite_rate_bucket(api))
+    time.sleep(delay)
+
+# Retried functions call other retried functions, e.g. pages of listings or batches, error given up by inner one is not retried again,
+# so there is one layer of retries and attempts never multiply
+def gsuite_retry(func):
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, "gsuite_retried", False) or not gsuite_error_retryable(e):
+                    raise
+                attempt += 1
+                if attempt >= GSUITE_RETRIES:
+                    e.gsuite_retried = True
+                    raise
+                gsuite_backoff(e, attempt)
+
+    return wrapper
+
+# Request class for built services, takes rate limit tokens by API of methodId (e.g. drive.files.list) on every execution
+class GsuiteHttpRequest(HttpRequest):
+
+    def execute(self, http=None, num_retries=0):
+        # Resumable uploads are executed by next_chunk, which takes tokens itself
+        if self.resumable is not None:
+            return super(GsuiteHttpRequest, self).execute(http=http, num_retries=num_retries)
+        bucket = gsuite_request_bucket(self)
+        if bucket is not None:
+            bucket.acquire(gsuite_request_tokens(self))
+        try:
+            response = super(GsuiteHttpRequest, self).execute(http=http, num_retries=num_retries)
+        except HttpError as e:
+            gsuite_throttled(e, bucket)
+            raise
+        if bucket is not None:
+            bucket.succeeded()
+        return response
+
+    # The first chunk starts the call and takes its tokens, the rest take one token of request rate limited APIs
+    def next_chunk(self, http=None, num_retries=0):
+        bucket = gsuite_request_bucket(self)
+        api = self.methodId.split(".")[0]
+        if bucket is not None and (self.resumable_uri is None or api not in GSUITE_PER_USER_APIS):
+            bucket.acquire(gsuite_request_tokens(self) if self.resumable_uri is None else 1)
+        try:
+            return super(GsuiteHttpRequest, self).next_chunk(http=http, num_retries=num_retries)
+        except HttpError as e:
+            gsuite_throttled(e, bucket)
+            raise
+
+# Discovery documents are static per API version, keep them in memory and on local disk between runs
+class DiscoveryFileCache(Cache):
+
+    def __init__(self, cache_dir, max_age=DISCOVERY_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, "discovery-{0}.json".format(hashlib.sha1(url.encode("utf-8")).hexdigest()))
+
+    def get(self, url):
+
+        with self.lock:
+            if url in self.memory:
+                return self.memory[url]
+
+        # Cache is best effort, any problem with the file means fetching the document again
+        try:
+            path = self._path(url)
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, "r", encoding="utf-8") as cache_file:
+                content = cache_file.read()
+        except (IOError, OSError):
+            return None
+
+        with self.lock:
+            self.memory[url] = content
+
+        return content
+
+    def set(self, url, content):
+
+        with self.lock:
+            self.memory[url] = content
+
+        # Write to temp file and rename, so parallel processes never read half written document
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700, exist_ok=True)
+            path = self._path(url)
+            tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                cache_file.write(content)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            pass
+
+_DISCOVERY_CACHE = DiscoveryFileCache(GSUITE_CACHE_DIR)
+
+# Process wide client registry
+# Key files are read once, credentials are shared by (key file, scopes, subject) and keep their access token until expiry
+# httplib2 is not thread safe, so service objects are built per thread from the cached discovery documents
+_SA_INFO = {}
+_CREDENTIALS = {}
+_CREDENTIALS_LOCK = threading.Lock()
+_THREAD_SERVICES = threading.local()
+
+def gsuite_credentials(sa_secrets_file, scopes, subject=None):
+
+    sa_secrets_file = os.path.abspath(sa_secrets_file)
+    key = (sa_secrets_file, tuple(scopes), subject)
+
+    with _CREDENTIALS_LOCK:
+
+        credentials = _CREDENTIALS.get(key)
+
+        if credentials is None:
+
+            base_key = (sa_secrets_file, tuple(scopes), None)
+            base_credentials = _CREDENTIALS.get(base_key)
+
+            if base_credentials is None:
+
+                if sa_secrets_file not in _SA_INFO:
+                    with open(sa_secrets_file, "r", encoding="utf-8") as sa_file:
+                        _SA_INFO[sa_secrets_file] = json.load(sa_file)
+
+                base_credentials = service_account.Credentials.from_service_account_info(_SA_INFO[sa_secrets_file], scopes=scopes)
+                _CREDENTIALS[base_key] = base_credentials
+
+            if subject is None:
+                credentials = base_credentials
+            else:
+                credentials = base_credentials.with_subject(subject)
+                _CREDENTIALS[key] = credentials
+
+    return credentials
+
+def gsuite_service(sa_secrets_file, api, version, scopes, subject=None):
+
+    services = getattr(_THREAD_SERVICES, "services", None)
+    if services is None:
+        services = {}
+        _THREAD_SERVICES.services = services
+
+    key = (os.path.abspath(sa_secrets_file), api, version, tuple(scopes), subject)
+    service = services.get(key)
+
+    if service is None:
+        credentials = gsuite_credentials(sa_secrets_file, scopes, subject)
+        service = build(api, version, credentials=credentials, cache=_DISCOVERY_CACHE, requestBuilder=GsuiteHttpRequest)
+        services[key] = service
+
+    return service
+
+# Execute list of (key, request) pairs with batch http requests of up to batch_size items each
+# Returns dict key -> {'response': response} or {'error': exception}, items failed with retryable errors are resent after backoff
+# Failed batch http requests are resent the same way, so callers should not retry on their own
+def gsuite_batch_execute(service, requests, batch_size=BATCH_SIZE):
+
+    results = {}
+    pending = list(requests)
+    attempt = 0
+
+    while pending:
+
+        retry_items = []
+        retry_error = None
+
+        for chunk_start in range(0, len(pending), batch_size):
+
+            chunk = pending[chunk_start:chunk_start + batch_size]
+
+            def callback(request_id, response, exception):
+                key, request = chunk[int(request_id)]
+                if exception is None:
+                    results[key] = {'response': response}
+                else:
+                    results[key] = {'error': exception}
+                    if gsuite_error_retryable(exception):
+                        gsuite_throttled(exception, gsuite_request_bucket(request))
+                        retry_items.append((key, request))
+
+            # Every item counts against quota
+            for key, request in chunk:
+                bucket = gsuite_request_bucket(request)
+                if bucket is not None:
+                    bucket.acquire(gsuite_request_tokens(request))
+
+            batch = service.new_batch_http_request(callback=callback)
+            for item_n, (key, request) in enumerate(chunk):
+                batch.add(request, request_id=str(item_n))
+
+            try:
+                batch.execute()
+            except Exception as e:
+                if not gsuite_error_retryable(e):
+                    raise
+                # Items answered before failure keep their results
+                for key, request in chunk:
+                    if key not in results:
+                        results[key] = {'error': e}
+                        retry_items.append((key, request))
+                retry_error = e
+
+        attempt += 1
+        if not retry_items:
+            break
+
+        if attempt >= GSUITE_RETRIES:
+            for key, request in retry_items:
+                results[key]['error'].gsuite_retried = True
+            break
+
+        gsuite_backoff(retry_error if retry_error is not None else results[retry_items[0][0]]['error'], attempt)
+        for key, request in retry_items:
+            del results[key]
+        pending = retry_items
+
+    return results
+
+@gsuite_retry
 def docs_get_as_json(sa_secrets_file, doc_id):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DOCS_SCOPES)
-        docs_service = build('docs', 'v1', credentials=credentials)
+        docs_service = gsuite_service(sa_secrets_file, 'docs', 'v1', DOCS_SCOPES)
 
         response = docs_service.documents().get(documentId=doc_id).execute()
     
@@ -43,337 +489,513 @@ def docs_get_as_json(sa_secrets_file, doc_id):
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def docs_replace_all_text(sa_secrets_file, doc_id, json_str):
+# Document model with tables indexed, fetched with narrow fields mask
+# Pass it as document to table functions to make several edits with one fetch
+# Given document is reloaded in place
+@gsuite_retry
+def docs_get_model(sa_secrets_file, doc_id, document=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DOCS_SCOPES)
-        docs_service = build('docs', 'v1', credentials=credentials)
+        docs_service = gsuite_service(sa_secrets_file, 'docs', 'v1', DOCS_SCOPES)
 
-        json_dict = json.loads(json_str)
+        response = docs_service.documents().get(documentId=doc_id, fields=DOCS_MODEL_FIELDS).execute()
 
-        requests = []
+        if document is None:
+            return DocsDocument(response)
+
+        document.load(response)
+        return document
 
-        for template in json_dict:
+    except:
+        raise
+
+@gsuite_retry
+def docs_replace_all_text(sa_secrets_file, doc_id, json_str, document=None):
+
+    try:
+
+        docs_service = gsuite_service(sa_secrets_file, 'docs', 'v1', DOCS_SCOPES)
+
+        json_dict = json.loads(json_str)
 
-            requests = requests + [
-                {   
-                    'replaceAllText': {
-                        'containsText': {
-                            'text': template,
-                            'matchCase':  'true'
-                        },
-                        'replaceText': json_dict[template]
-                    }
-                }
-            ]
+        requests = docs_replace_all_text_requests(json_dict)
 
         response = docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
 
+        # Replacements move indices in a way which cannot be tracked locally
+        if document is not None:
+            document.stale = True
+
         return response
     
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def docs_insert_table_rows(sa_secrets_file, doc_id, table_num, below_row_number, json_str):
+# Returns document model to edit, fetched if not given or stale
+# Edit functions are not retried as a whole: model is fetched once, then only docs_batch_update is retried with its revision,
+# so a retry after an applied but lost write fails on revision instead of fetching the new revision and writing again
+def docs_model_for_edit(sa_secrets_file, doc_id, document):
 
-    try:
+    if document is None or document.stale:
+        return docs_get_model(sa_secrets_file, doc_id, document)
+
+    return document
+
+def docs_insert_table_rows(sa_secrets_file, doc_id, table_num, below_row_number, json_str, document=None):
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DOCS_SCOPES)
-        docs_service = build('docs', 'v1', credentials=credentials)
+    try:
 
         json_list = json.loads(json_str)
-        below_row_index = int(below_row_number) - 1
         table_num = int(table_num)
 
-        # Get table index
+        document = docs_model_for_edit(sa_secrets_file, doc_id, document)
 
-        response = docs_service.documents().get(documentId=doc_id).execute()
+        requests = docs_insert_table_rows_requests(document, table_num, below_row_number, json_list)
+
+        response = docs_batch_update(sa_secrets_file, doc_id, requests, document.revision_id)
+
+        document.updated(response)
+        document.inserted_rows(table_num, below_row_number, json_list)
 
-        content = response['body']['content']
-        table_n = 0
-        table_index = None
+        return response
+
+    except:
+        raise
+
+def docs_delete_table_row(sa_secrets_file, doc_id, table_num, row_number, document=None):
+
+    try:
+
+        table_num = int(table_num)
+
+        document = docs_model_for_edit(sa_secrets_file, doc_id, document)
 
-        for element in content:
+        requests = docs_delete_table_row_requests(document, table_num, row_number)
 
-            if "table" in element:
+        response_delete_row = docs_batch_update(sa_secrets_file, doc_id, requests, document.revision_id)
 
-                table_n += 1
-                if table_n == table_num:
+        document.updated(response_delete_row)
+        document.deleted_row(table_num, row_number)
+
+        return response_delete_row
 
-                    # Save table startIndex
-                    table_index = element['startIndex']
+    except:
+        raise
 
-                    # Save endIndex of the row below which we will insert
-                    # We can calc new row first cell startIndex by this endIndex
+# Edit plan is JSON with optional keys, the same as in batch manifest document:
+# {
+#   "replace_all_text": {"__KEY1__": "Value 1"},
+#   "insert_table_rows": [{"table_num": 1, "below_row_number": 1, "rows": [["Cell 1-1", "Cell 1-2"]]}],
+#   "delete_table_rows": [{"table_num": 2, "row_number": 3}]
+# }
+# Table and row numbers refer to the document as it is before the plan, rows inserted below the same row keep plan order
+# All edits are sent in one batchUpdate: row edits back-to-front so that every index stays valid, then replacements
+# Replacements go last as they move indices unpredictably, so they are applied to inserted rows as well
+def docs_apply_edit_plan(sa_secrets_file, doc_id, json_str, document=None):
 
-                    table = element['table']
-                    rows = table['tableRows']
-                    row_n = 0
-                    row_end_index = None
+    try:
 
-                    # Check if requested below_row_num is out of table rows
-                    if int(below_row_number) > len(rows):
-                        raise ValueError("Table {0} has less than {1} rows ({2} actually)".format(table_num, below_row_number, len(rows)))
+        plan = json.loads(json_str)
 
-                    for row in rows: # For some reason row[x] doesn't work, so just iterate
+        document = docs_model_for_edit(sa_secrets_file, doc_id, document)
 
-                        row_n += 1
-                        if row_n == int(below_row_number):
+        # Row edits as (table startIndex, position within table, plan order, edit)
+        # Insert below row goes after this row deletion in document order
 
-                            row_end_index = int(row['endIndex'])
+        edits = []
 
-                    if row_end_index is None:
-                        raise ValueError("Row {0} index for table {1} not found".format(below_row_number, table_num))
+        for plan_n, insert in enumerate(plan.get('insert_table_rows', [])):
+            table_num = int(insert['table_num'])
+            below_row_number = int(insert['below_row_number'])
+            document.row(table_num, below_row_number)
+            edits.append((document.table(table_num)['startIndex'], below_row_number + 0.5, plan_n, ('insert', table_num, below_row_number, insert['rows'])))
 
-        if table_index is None:
-            raise ValueError("Table index for TABLE_NUM = {0} not found".format(table_num))
+        deleted = set()
+        for plan_n, delete in enumerate(plan.get('delete_table_rows', [])):
+            table_num = int(delete['table_num'])
+            row_number = int(delete['row_number'])
+            if (table_num, row_number) in deleted:
+                raise ValueError("Row {0} of table {1} is deleted more than once".format(row_number, table_num))
+            deleted.add((table_num, row_number))
+            document.row(table_num, row_number)
+            edits.append((document.table(table_num)['startIndex'], row_number, plan_n, ('delete', table_num, row_number, None)))
+
+        edits.sort(key=lambda edit: edit[0:3], reverse=True)
 
-        # Iterate on first dimension of json_list - rows - starting from last row
-        # As per https://developers.google.com/docs/api/how-tos/best-practices data should be filled backwards
-        # Populate requests list in iterations
-        
         requests = []
-        json_list.reverse()
-        for list_row in json_list:
 
-            # Insert new row
-            requests = requests + [
-                {
-                    'insertTableRow': {
-                        'tableCellLocation': {
-                            'tableStartLocation': {
-                                'index': table_index
-                            },
-                            'rowIndex': below_row_index,
-                            'columnIndex': 0
-                        },
-                        'insertBelow': 'true'
-                    }
-                }
-            ]
-
-            # Fill row values, also backwards
-
-            list_n = 0
-            list_row.reverse()
-
-            for list_cell in list_row:
-
-                requests = requests + [
-                    {
-                        'insertText': {
-                            'location': {
-                                'index': row_end_index + ( 2 * (len(list_row) - list_n) )
-                            },
-                            'text': list_cell
-                        }
-                    }
-                ]
-
-                list_n += 1
+        for _, _, _, (action, table_num, row_number, rows) in edits:
+            if action == 'insert':
+                docs_insert_table_rows_requests(document, table_num, row_number, rows, requests)
+            else:
+                docs_delete_table_row_requests(document, table_num, row_number, requests)
 
-        response = docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
+        docs_replace_all_text_requests(plan.get('replace_all_text', {}), requests)
+
+        if not requests:
+            return None
+
+        response = docs_batch_update(sa_secrets_file, doc_id, requests, document.revision_id)
+
+        document.updated(response)
+
+        # Track row edits in the order they were applied, each of them moved only what is after the next ones
+        if plan.get('replace_all_text'):
+            document.stale = True
+        else:
+            for _, _, _, (action, table_num, row_number, rows) in edits:
+                if action == 'insert':
+                    document.inserted_rows(table_num, row_number, rows)
+                else:
+                    document.deleted_row(table_num, row_number)
 
         return response
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def docs_delete_table_row(sa_secrets_file, doc_id, table_num, row_number):
+# One batchUpdate guarded by revision, retried on its own
+# If the first attempt was applied but its response lost, the retry fails on revision instead of applying twice
+@gsuite_retry
+def docs_batch_update(sa_secrets_file, doc_id, requests, revision_id):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DOCS_SCOPES)
-        docs_service = build('docs', 'v1', credentials=credentials)
+        docs_service = gsuite_service(sa_secrets_file, 'docs', 'v1', DOCS_SCOPES)
+
+        body = {
+            'requests': requests,
+            'writeControl': {
+                'requiredRevisionId': revision_id
+            }
+        }
+
+        return docs_service.documents().batchUpdate(documentId=doc_id, body=body).execute()
+
+    except:
+        raise
+
+# Sends requests ordered back-to-front in size limited chunks, each chunk requires revision made by the previous one
+def docs_batch_update_chunks(sa_secrets_file, doc_id, requests, document):
+
+    responses = []
+
+    for chunk in docs_requests_chunks(requests, DOCS_BATCH_MAX_REQUESTS, DOCS_BATCH_MAX_BYTES):
+        response = docs_batch_update(sa_secrets_file, doc_id, chunk, document.revision_id)
+        document.updated(response)
+        responses.append(response)
+
+    return responses
+
+# Bulk variant of docs_insert_table_rows for large tables
+# Empty rows are inserted first, then document is fetched again and cells are filled by their real content indices
+# Both steps are split into chunks of DOCS_BATCH_MAX_REQUESTS requests or DOCS_BATCH_MAX_BYTES, returns list of responses
+def docs_fill_table_rows(sa_secrets_file, doc_id, table_num, below_row_number, json_str, document=None):
+
+    try:
 
-        row_index = int(row_number) - 1
+        json_list = json.loads(json_str)
         table_num = int(table_num)
+        below_row_number = int(below_row_number)
 
-        # Get table index
+        document = docs_model_for_edit(sa_secrets_file, doc_id, document)
 
-        response = docs_service.documents().get(documentId=doc_id).execute()
+        # Check rows before changing anything, new rows have cells of the row below which they are inserted
+        cell_count = len(document.row(table_num, below_row_number)['cells'])
+        for list_row in json_list:
+            if len(list_row) > cell_count:
+                raise ValueError("Row {0} has more cells than {1} cells of table {2}".format(list_row, cell_count, table_num))
+
+        requests = docs_insert_empty_table_rows_requests(document, table_num, below_row_number, len(json_list))
+        responses = docs_batch_update_chunks(sa_secrets_file, doc_id, requests, document)
 
-        content = response['body']['content']
-        table_n = 0
-        table_index = None
+        document = docs_get_model(sa_secrets_file, doc_id, document)
 
-        for element in content:
+        requests = docs_fill_table_cells_requests(document, table_num, below_row_number + 1, json_list)
+        responses.extend(docs_batch_update_chunks(sa_secrets_file, doc_id, requests, document))
 
-            if "table" in element:
+        # Texts moved indices after them
+        if requests:
+            document.stale = True
 
-                table_n += 1
-                if table_n == table_num:
+        return responses
 
-                    # Save table startIndex
-                    table_index = element['startIndex']
+    except:
+        raise
 
-                    # Save endIndex of the row which we will delete
-                    # We can calc new row first cell startIndex by this endIndex
+# Drive metadata cache, enabled by DRIVE_CACHE_FILE env
+if DRIVE_CACHE_FILE is not None:
+    _DRIVE_CACHE = DriveCache(DRIVE_CACHE_FILE)
+else:
+    _DRIVE_CACHE = None
 
-                    table = element['table']
-                    rows = table['tableRows']
-                    row_n = 0
-                    row_end_index = None
+# Returns cache brought up to date with changes API or None if cache is disabled
+# Changes are fetched at most once per DRIVE_CACHE_SYNC_INTERVAL seconds, sync time is shared by all processes using the cache file
+def drive_cache_sync(sa_secrets_file, drive_user=None):
 
-                    # Check if requested row_num is out of table rows
-                    if int(row_number) > len(rows):
-                        raise ValueError("Table {0} has less than {1} rows ({2} actually)".format(table_num, row_number, len(rows)))
+    if _DRIVE_CACHE is None:
+        return None
 
-                    for row in rows: # For some reason row[x] doesn't work, so just iterate
+    account = drive_user or ""
 
-                        row_n += 1
-                        if row_n == int(row_number):
+    if not _DRIVE_CACHE.sync_due(account, DRIVE_CACHE_SYNC_INTERVAL):
+        return _DRIVE_CACHE
 
-                            row_end_index = int(row['endIndex'])
+    drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+    page_token = _DRIVE_CACHE.page_token(account)
 
-                    if row_end_index is None:
-                        raise ValueError("Row {0} index for table {1} not found".format(row_number, table_num))
+    # Nothing could be cached before the first token, so start from the current state
+    if page_token is None:
+        response = drive_service.changes().getStartPageToken(supportsAllDrives=True).execute()
+        _DRIVE_CACHE.reset(account)
+        _DRIVE_CACHE.synced(account, response['startPageToken'])
+        return _DRIVE_CACHE
 
-        if table_index is None:
-            raise ValueError("Table index for TABLE_NUM = {0} not found".format(table_num))
+    while True:
 
-        # Insert new row
+        try:
+            response = drive_service.changes().list(pageToken=page_token, pageSize=DRIVE_PAGE_SIZE, supportsAllDrives=True, includeItemsFromAllDrives=True, fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, parents))").execute()
+        except HttpError as e:
+            # Token is not accepted anymore, cached data cannot be trusted
+            if e.resp.status in [400, 404, 410]:
+                _DRIVE_CACHE.reset(account)
+                return drive_cache_sync(sa_secrets_file, drive_user)
+            raise
 
-        requests = [
-            {
-                'deleteTableRow': {
-                    'tableCellLocation': {
-                        'tableStartLocation': {
-                            'index': table_index
-                        },
-                        'rowIndex': row_index,
-                        'columnIndex': 0
-                    }
-                }
-            }
-        ]
+        _DRIVE_CACHE.apply_changes(account, response.get('changes', []))
 
-        response_delete_row = docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
+        if 'newStartPageToken' in response:
+            _DRIVE_CACHE.synced(account, response['newStartPageToken'])
+            break
 
-        return response_delete_row
+        page_token = response['nextPageToken']
+
+    return _DRIVE_CACHE
+
+# One page of files().list, retried separately so long listings do not restart from the first page
+# Items of shared drives are listed only if both all drives flags are set
+@gsuite_retry
+def drive_ls_page(sa_secrets_file, q, page_token, fields, drive_user=None, page_size=DRIVE_PAGE_SIZE):
+
+    try:
+
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+        return drive_service.files().list(pageSize=page_size, fields=fields, pageToken=page_token, q=q, supportsAllDrives=True, includeItemsFromAllDrives=True).execute()
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def drive_ls(sa_secrets_file, cd_folder, drive_user=None):
+# One page of permissions().list, retried separately like drive_ls_page
+@gsuite_retry
+def drive_ls_perms_page(sa_secrets_file, ls_perms_id, page_token, fields, drive_user=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
-        page_token = None
-        return_items = []
+        return drive_service.permissions().list(pageSize=100, fields=fields, pageToken=page_token, fileId=ls_perms_id).execute()
 
-        while True:
+    except:
+        raise
 
-            if cd_folder == "ALL":
-                q = ""
-            else:
-                q = "'{0}' in parents".format(cd_folder)
+# Generator, yields files page by page, so output could start before the whole listing is done
+# With cache enabled folders listed before are served from cache, folders listed now are saved to cache
+def drive_ls_iter(sa_secrets_file, cd_folder, drive_user=None):
 
-            # Try to list files, suppress errors
-            try:
-                response = drive_service.files().list(pageSize=100, fields="nextPageToken, files(id, name, mimeType)", pageToken=page_token, q=q).execute()
-                items = response.get('files', [])
-                page_token = response.get('nextPageToken', None)
-            except:
-                raise 
-            
-            for item in items:
-                return_items.append({'id': item['id'], 'name': item['name'], 'mimeType': item['mimeType']})
+    if cd_folder == "ALL":
+        q = ""
+        cache = None
+    else:
+        q = "{0} in parents".format(drive_query_string(cd_folder))
+        cache = drive_cache_sync(sa_secrets_file, drive_user)
 
-            if page_token is None:
-                break
+    if cache is not None:
+        cached_items = cache.folder_items(drive_user or "", cd_folder)
+        if cached_items is not None:
+            for item in cached_items:
+                yield item
+            return
+        listed_items = []
 
-        return return_items
+    page_token = None
+
+    while True:
+
+        response = drive_ls_page(sa_secrets_file, q, page_token, "nextPageToken, files(id, name, mimeType)", drive_user)
+        page_token = response.get('nextPageToken', None)
+
+        for item in response.get('files', []):
+            item = {'id': item['id'], 'name': item['name'], 'mimeType': item['mimeType']}
+            if cache is not None:
+                listed_items.append(item)
+            yield item
+
+        if page_token is None:
+            break
+
+    if cache is not None:
+        cache.set_folder_items(drive_user or "", cd_folder, listed_items)
+
+# Values in files().list queries are quoted with single quotes, quotes and backslashes inside are escaped
+def drive_query_string(value):
+
+    return "'{0}'".format(value.replace("\\", "\\\\").replace("'", "\\'"))
+
+def drive_find_query(in_id, name):
+
+    return "{0} in parents and name = {1}".format(drive_query_string(in_id), drive_query_string(name))
+
+# Returns ID of the first file named name within folder in_id or None
+def drive_find(sa_secrets_file, in_id, name, drive_user=None):
+
+    cache = drive_cache_sync(sa_secrets_file, drive_user)
+
+    if cache is not None:
+        if not cache.folder_listed(drive_user or "", in_id):
+            for item in drive_ls_iter(sa_secrets_file, in_id, drive_user):
+                pass
+        return cache.find(drive_user or "", in_id, name)
+
+    drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+    # Get only one page with 1 result
+    response = drive_service.files().list(pageSize=1, fields="files(id, name)", q=drive_find_query(in_id, name), supportsAllDrives=True, includeItemsFromAllDrives=True).execute()
+    items = response.get('files', [])
+
+    if not items:
+        return None
+
+    return items[0]['id']
+
+def drive_ls(sa_secrets_file, cd_folder, drive_user=None):
+
+    try:
+
+        return list(drive_ls_iter(sa_secrets_file, cd_folder, drive_user))
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
+# Generator, yields permissions page by page
+def drive_ls_perms_iter(sa_secrets_file, ls_perms_id, drive_user=None):
+
+    page_token = None
+
+    while True:
+
+        response = drive_ls_perms_page(sa_secrets_file, ls_perms_id, page_token, "nextPageToken, permissions(id, type, emailAddress, role)", drive_user)
+        page_token = response.get('nextPageToken', None)
+
+        for item in response.get('permissions', []):
+            # anyone and domain permissions have no email address
+            yield {'id': item['id'], 'type': item['type'], 'emailAddress': item.get('emailAddress', ""), 'role': item['role']}
+
+        if page_token is None:
+            break
+
 def drive_ls_perms(sa_secrets_file, ls_perms_id, drive_user=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        return list(drive_ls_perms_iter(sa_secrets_file, ls_perms_id, drive_user))
 
-        page_token = None
-        return_items = []
+    except:
+        raise
 
-        while True:
+# Recursive listing of folder cd_folder, subfolders are listed concurrently by up to workers threads
+# Generator, yields {'id', 'name', 'mimeType', 'path'} as pages arrive, path is relative to cd_folder
+def drive_walk(sa_secrets_file, cd_folder, drive_user=None, workers=DRIVE_WORKERS):
 
-            # Try to list files, suppress errors
-            try:
-                response = drive_service.permissions().list(pageSize=100, fields="nextPageToken, permissions(id, type, emailAddress, role)", pageToken=page_token, fileId=ls_perms_id).execute()
-                items = response.get('permissions', [])
+    fields = "nextPageToken, files(id, name, mimeType)"
+
+    # Queue of (folder id, folder path, page token) waiting to be listed
+    # Only workers * 2 pages are requested at once, so deep trees do not pile up futures and results
+    folders = deque([(cd_folder, "", None)])
+    seen_folders = set([cd_folder])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        running = {}
+
+        while folders or running:
+
+            while folders and len(running) < workers * 2:
+                folder_id, folder_path, page_token = folders.popleft()
+                future = executor.submit(drive_ls_page, sa_secrets_file, "{0} in parents".format(drive_query_string(folder_id)), page_token, fields, drive_user)
+                running[future] = (folder_id, folder_path)
+
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+
+                folder_id, folder_path = running.pop(future)
+                response = future.result()
+
+                # Next page of the same folder goes first to finish folders already started
                 page_token = response.get('nextPageToken', None)
-            except:
-                raise
+                if page_token is not None:
+                    folders.appendleft((folder_id, folder_path, page_token))
 
-            for item in items:
-                return_items.append({'id': item['id'], 'type': item['type'], 'emailAddress': item['emailAddress'], 'role': item['role']})
+                for item in response.get('files', []):
 
-            if page_token is None:
-                break
+                    if folder_path:
+                        item_path = "{0}/{1}".format(folder_path, item['name'])
+                    else:
+                        item_path = item['name']
 
-        return return_items
+                    if item['mimeType'] == DRIVE_FOLDER_MIME_TYPE and item['id'] not in seen_folders:
+                        seen_folders.add(item['id'])
+                        folders.append((item['id'], item_path, None))
+
+                    yield {'id': item['id'], 'name': item['name'], 'mimeType': item['mimeType'], 'path': item_path}
+
+@gsuite_retry
+def drive_rm(sa_secrets_file, file_id, drive_user=None):
+
+    try:
+
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+        response = drive_service.files().delete(fileId=file_id).execute()
+
+        if _DRIVE_CACHE is not None:
+            _DRIVE_CACHE.remove(drive_user or "", file_id)
+
+        return response
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def drive_rm(sa_secrets_file, file_id, drive_user=None):
+@gsuite_retry
+def drive_rename(sa_secrets_file, file_id, cd_id, file_name, drive_user=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+        response = drive_service.files().update(fileId=file_id, body={'name': file_name}, fields='id, mimeType').execute()
+
+        if _DRIVE_CACHE is not None:
+            _DRIVE_CACHE.add(drive_user or "", file_id, cd_id, file_name, response['mimeType'])
 
-        return drive_service.files().delete(fileId=file_id).execute()
+        return response
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
+@gsuite_retry
 def drive_mkdir(sa_secrets_file, in_id, folder_name, drive_user=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            print(drive_user)
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
         # Query if the same file already exists
-        q = "'{0}' in parents and name = '{1}'".format(in_id, folder_name)
+        found_id = drive_find(sa_secrets_file, in_id, folder_name, drive_user)
 
-        # Get only one page with 1 result
-        response = drive_service.files().list(pageSize=1, fields="files(id, name)", q=q).execute()
-        items = response.get('files', [])
-
-        if not items:
+        if found_id is None:
 
             body = {
                 'name': folder_name,
@@ -383,42 +1005,39 @@ def drive_mkdir(sa_secrets_file, in_id, folder_name, drive_user=None):
 
             folder = drive_service.files().create(body=body).execute()
 
+            if _DRIVE_CACHE is not None:
+                _DRIVE_CACHE.add(drive_user or "", folder['id'], in_id, folder_name, DRIVE_FOLDER_MIME_TYPE)
+
             return folder['id']
 
         else:
 
-            return items[0]['id']
+            return found_id
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
+@gsuite_retry
 def drive_cp(sa_secrets_file, source_id, cd_id, file_name, drive_user=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
         # Query if the same file already exists
-        q = "'{0}' in parents and name = '{1}'".format(cd_id, file_name)
-
-        # Get only one page with 1 result
-        response = drive_service.files().list(pageSize=1, fields="files(id, name)", q=q).execute()
-        items = response.get('files', [])
+        found_id = drive_find(sa_secrets_file, cd_id, file_name, drive_user)
 
-        if not items:
+        if found_id is None:
 
             body = {
                 'name': file_name,
                 'parents': [cd_id]
             }
 
-            new_file = drive_service.files().copy(fileId=source_id, body=body).execute()
+            new_file = drive_service.files().copy(fileId=source_id, body=body, fields='id, mimeType').execute()
+
+            if _DRIVE_CACHE is not None:
+                _DRIVE_CACHE.add(drive_user or "", new_file['id'], cd_id, file_name, new_file['mimeType'])
 
             return new_file['id']
 
@@ -429,238 +1048,1048 @@ def drive_cp(sa_secrets_file, source_id, cd_id, file_name, drive_user=None):
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def drive_pdf(sa_secrets_file, file_id, file_name, drive_user=None):
+# Downloads are written to NAME.part and renamed to NAME when complete, so partial files never look complete
+
+# Export is generated by Drive on request and cannot be fetched by ranges, so only chunk size is tunable
+@gsuite_retry
+def drive_pdf(sa_secrets_file, file_id, file_name, drive_user=None, chunk_size=DRIVE_CHUNK_SIZE):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
         request = drive_service.files().export_media(fileId=file_id, mimeType='application/pdf')
 
-        fh = io.FileIO(file_name, "wb")
-        downloader = MediaIoBaseDownload(fh, request)
+        part_file = "{0}.part".format(file_name)
+        fh = io.FileIO(part_file, "wb")
+        downloader = MediaIoBaseDownload(fh, request, chunksize=chunk_size)
         done = False
         while done is False:
+            gsuite_rate_limit('drive')
             status, done = downloader.next_chunk()
         fh.close()
+        os.replace(part_file, file_name)
         return status.progress() * 100
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def drive_download(sa_secrets_file, file_id, file_name, drive_user=None):
+# One range of file content, service is taken per thread so ranges could be fetched in parallel
+@gsuite_retry
+def drive_download_range(sa_secrets_file, file_id, range_start, range_end, drive_user=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
         request = drive_service.files().get_media(fileId=file_id)
+        gsuite_rate_limit('drive')
+        resp, content = request.http.request(request.uri, method="GET", headers={'range': "bytes={0}-{1}".format(range_start, range_end)})
 
-        fh = io.FileIO(file_name, "wb")
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        fh.close()
-        return status.progress() * 100
+        if resp.status not in [200, 206]:
+            raise HttpError(resp, content, uri=request.uri)
+
+        # Server may ignore range and send everything
+        if resp.status == 200:
+            content = content[range_start:range_end + 1]
+
+        if len(content) != range_end - range_start + 1:
+            raise ConnectionError("Got {0} bytes of range {1}-{2} of file {3}".format(len(content), range_start, range_end, file_id))
+
+        return content
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def drive_upload(sa_secrets_file, file_local, cd_id, file_name, drive_user=None):
+# File is fetched by chunk_size ranges with up to workers ranges in parallel
+# Completed ranges are saved to NAME.part.json, so interrupted download continues with missing ranges only
+# progress is optional callable(downloaded bytes, total bytes) called after each range
+@gsuite_retry
+def drive_download(sa_secrets_file, file_id, file_name, drive_user=None, chunk_size=DRIVE_CHUNK_SIZE, workers=1, progress=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=DRIVE_SCOPES)
-        if drive_user is None:
-            drive_service = build('drive', 'v3', credentials=credentials)
-        else:
-            delegated_credentials = credentials.with_subject(drive_user)
-            drive_service = build('drive', 'v3', credentials=delegated_credentials)
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
-        # Query if the same file already exists
-        q = "'{0}' in parents and name = '{1}'".format(cd_id, file_name)
+        metadata = drive_service.files().get(fileId=file_id, fields="size, modifiedTime").execute()
+        size = int(metadata['size'])
 
-        # Get only one page with 1 result
-        response = drive_service.files().list(pageSize=1, fields="files(id, name)", q=q).execute()
-        items = response.get('files', [])
+        part_file = "{0}.part".format(file_name)
+        state_file = "{0}.part.json".format(file_name)
 
-        if not items:
+        # Continue only if file was not modified since the interrupted download
+        state = None
+        if os.path.isfile(state_file) and os.path.isfile(part_file):
+            with open(state_file, "r") as f:
+                state = json.load(f)
+            if state['modifiedTime'] != metadata['modifiedTime'] or state['size'] != size:
+                state = None
 
-            body = {
-                'name': file_name,
-                'parents': [cd_id]
+        if state is None:
+            state = {
+                'modifiedTime': metadata['modifiedTime'],
+                'size': size,
+                'chunk_size': chunk_size,
+                'done': []
             }
+            with open(part_file, "wb") as f:
+                f.truncate(size)
 
-            media = MediaFileUpload(file_local)
-            new_file = drive_service.files().create(body=body, media_body=media, fields='id').execute()
-
-            return new_file['id']
-        
-        else:
-
-            return None
-
-    except:
-        raise
+        chunk_size = state['chunk_size']
+        chunk_count = (size + chunk_size - 1) // chunk_size
+        done_chunks = set(state['done'])
+        state_lock = threading.Lock()
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def sheets_get_as_json(sa_secrets_file, spreadsheet_id, sheet_id, range_id, dimension, render, datetime_render):
+        def save_state():
+            with open("{0}.tmp".format(state_file), "w") as f:
+                json.dump(state, f)
+            os.replace("{0}.tmp".format(state_file), state_file)
 
-    try:
+        save_state()
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=SHEETS_SCOPES)
-        sheets_service = build('sheets', 'v4', credentials=credentials)
+        fd = os.open(part_file, os.O_WRONLY)
 
-        sheet = sheets_service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=spreadsheet_id, range="{0}!{1}".format(sheet_id, range_id), majorDimension=dimension, valueRenderOption=render, dateTimeRenderOption=datetime_render).execute()
-        values = result.get('values', [])
+        try:
 
-        # Calculate range column size
+            def fetch_chunk(chunk_n):
+                range_start = chunk_n * chunk_size
+                range_end = min(size, range_start + chunk_size) - 1
+                content = drive_download_range(sa_secrets_file, file_id, range_start, range_end, drive_user)
+                os.pwrite(fd, content, range_start)
+                with state_lock:
+                    state['done'].append(chunk_n)
+                    save_state()
+                    downloaded = min(size, len(state['done']) * chunk_size)
+                if progress is not None:
+                    progress(downloaded, size)
 
-        num = 0
-        for c in range_id.split(":")[0]:
-            if c in string.ascii_letters:
-                num = num * 26 + (ord(c.upper()) - ord('A')) + 1
-        left_column = num
-        
-        num = 0
-        for c in range_id.split(":")[1]:
-            if c in string.ascii_letters:
-                num = num * 26 + (ord(c.upper()) - ord('A')) + 1
-        right_column = num
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(fetch_chunk, chunk_n) for chunk_n in range(chunk_count) if chunk_n not in done_chunks]
+                for future in futures:
+                    future.result()
 
-        range_size = right_column - left_column + 1
+            os.fsync(fd)
 
-        # Sheets api omits row tail if its values are empty
-        # Rebuild values filling tails with empty strings truncated tails
+        finally:
+            os.close(fd)
 
-        new_values = []
-        for row in values:
-            new_row = []
-            for col_num in range(range_size):
-                try:
-                    new_row.append(row[col_num])
-                except IndexError:
-                    new_row.append("")
-            new_values.append(new_row)
+        os.replace(part_file, file_name)
+        os.remove(state_file)
 
-        return new_values
+        return 100.0
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def sheets_append_data(sa_secrets_file, spreadsheet_id, sheet_id, range_id, dimension, json_str):
+# Download or export as pdf many files concurrently, items is a list of (file ID, file name) pairs
+# Returns dict file ID -> {'file': file name} or {'error': error message}
+def drive_download_many(sa_secrets_file, items, drive_user=None, workers=DRIVE_WORKERS, chunk_size=DRIVE_CHUNK_SIZE, pdf=False):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=SHEETS_SCOPES)
-        sheets_service = build('sheets', 'v4', credentials=credentials)
+        def download_one(file_id, file_name):
+            if pdf:
+                drive_pdf(sa_secrets_file, file_id, file_name, drive_user, chunk_size)
+            else:
+                drive_download(sa_secrets_file, file_id, file_name, drive_user, chunk_size)
 
-        json_dict = json.loads(json_str)
-        
-        request = {
-            "majorDimension": dimension,
-            "values": json_dict
-        }
+        return_items = {}
 
-        response = sheets_service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range="{0}!{1}".format(sheet_id, range_id), valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS", body=request).execute()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
 
-        return response
+            futures = {}
+            for file_id, file_name in items:
+                futures[executor.submit(download_one, file_id, file_name)] = (file_id, file_name)
+
+            for future in futures:
+                file_id, file_name = futures[future]
+                try:
+                    future.result()
+                    return_items[file_id] = {'file': file_name}
+                except Exception as e:
+                    return_items[file_id] = {'error': str(e)}
+
+        return return_items
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def gmail_create_draft(sa_secrets_file, gmail_user, message_from, message_to, message_cc, message_bcc, message_subject, message_text, attach_str):
+# Upload session URI of interrupted upload is kept in file named by local file (with its size and mtime) and target
+# So the next attempt or the next run continues from the last chunk received by Drive
+def drive_upload_session_file(file_local, cd_id, file_name, drive_user=None):
 
-    try:
+    file_stat = os.stat(file_local)
+    key = json.dumps([os.path.abspath(file_local), file_stat.st_size, file_stat.st_mtime_ns, cd_id, file_name, drive_user])
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=GMAIL_SCOPES)
-        delegated_credentials = credentials.with_subject(gmail_user)
-        gmail_service = build('gmail', 'v1', credentials=delegated_credentials)
+    return os.path.join(DRIVE_UPLOADS_DIR, "{0}.json".format(hashlib.sha1(key.encode("utf-8")).hexdigest()))
 
-        message_text_new_lines = message_text.replace('\\n', '\n')
-        attach_list = json.loads(attach_str)
+# progress is optional callable(uploaded bytes, total bytes) called after each chunk
+@gsuite_retry
+def drive_upload(sa_secrets_file, file_local, cd_id, file_name, drive_user=None, chunk_size=DRIVE_CHUNK_SIZE, progress=None):
 
-        message = MIMEMultipart()
-        message['From'] = message_from
-        message['To'] = message_to
-        message['Cc'] = message_cc
-        message['Bcc'] = message_bcc
-        message['Subject'] = message_subject
+    try:
 
-        message.attach(MIMEText(message_text_new_lines, "plain"))
+        if chunk_size % DRIVE_CHUNK_SIZE_UNIT != 0:
+            raise ValueError("Chunk size {0} is not a multiple of {1}".format(chunk_size, DRIVE_CHUNK_SIZE_UNIT))
 
-        for file_name in attach_list:
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
 
-            with open(file_name, "rb") as attachment:
+        # Query if the same file already exists
+        found_id = drive_find(sa_secrets_file, cd_id, file_name, drive_user)
 
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(attachment.read())
+        if found_id is None:
 
-            encoders.encode_base64(part)
-            part.add_header("Content-Disposition", "attachment", filename=os.path.basename(file_name))
-            message.attach(part)
+            body = {
+                'name': file_name,
+                'parents': [cd_id]
+            }
 
-        b64_bytes = base64.urlsafe_b64encode(message.as_bytes())
-        b64_string = b64_bytes.decode()
-        message_body = {'raw': b64_string}
-        message = {'message': message_body}
-        draft = gmail_service.users().drafts().create(userId='me', body=message).execute()
+            mime_type, mime_encoding = mimetypes.guess_type(file_local)
+            if mime_type is None:
+                mime_type = "application/octet-stream"
 
-        return draft['id'], draft['message']
+            # Resumable upload cannot send empty file
+            if os.path.getsize(file_local) == 0:
+                media = MediaFileUpload(file_local, mimetype=mime_type)
+                new_file = drive_service.files().create(body=body, media_body=media, fields='id, mimeType').execute()
+            else:
+                new_file = drive_upload_resumable(drive_service, body, file_local, mime_type, drive_upload_session_file(file_local, cd_id, file_name, drive_user), chunk_size, progress)
 
-    except:
+            if _DRIVE_CACHE is not None:
+                _DRIVE_CACHE.add(drive_user or "", new_file['id'], cd_id, file_name, new_file['mimeType'])
+
+            return new_file['id']
+
+        else:
+
+            return None
+
+    except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
-def gmail_list_messages(sa_secrets_file, gmail_user):
+def drive_upload_resumable(drive_service, body, file_local, mime_type, session_file, chunk_size, progress=None):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=GMAIL_SCOPES)
-        delegated_credentials = credentials.with_subject(gmail_user)
-        gmail_service = build('gmail', 'v1', credentials=delegated_credentials)
+        media = MediaFileUpload(file_local, mimetype=mime_type, chunksize=chunk_size, resumable=True)
+        request = drive_service.files().create(body=body, media_body=media, fields='id, mimeType')
 
-        response = gmail_service.users().messages().list(userId=gmail_user).execute()
-        return_list = []
+        resumed = False
+        if os.path.isfile(session_file):
+            with open(session_file, "r") as f:
+                request.resumable_uri = json.load(f)['uri']
+            # Error state makes the client ask Drive for already received range before sending the next chunk
+            request._in_error_state = True
+            resumed = True
+
+        response = None
+        while response is None:
+
+            try:
+                status, response = request.next_chunk()
+            except HttpError as e:
+                # Sessions expire after a week, start from zero
+                if resumed and e.resp.status in [404, 410]:
+                    os.remove(session_file)
+                    return drive_upload_resumable(drive_service, body, file_local, mime_type, session_file, chunk_size, progress)
+                raise
+
+            if not resumed:
+                if not os.path.isdir(DRIVE_UPLOADS_DIR):
+                    os.makedirs(DRIVE_UPLOADS_DIR, 0o700, exist_ok=True)
+                with open(session_file, "w") as f:
+                    json.dump({'uri': request.resumable_uri, 'file': os.path.abspath(file_local)}, f)
+                resumed = True
+
+            if progress is not None:
+                if status is not None:
+                    progress(status.resumable_progress, status.total_size)
+                else:
+                    progress(media.size(), media.size())
+
+        if os.path.isfile(session_file):
+            os.remove(session_file)
+
+        return response
+
+    except:
+        raise
+
+# Batch variants, up to BATCH_SIZE calls per http request
+# Return dict file_id -> result, where failed items have 'error' key with error message
+
+def drive_rm_many(sa_secrets_file, file_ids, drive_user=None):
+
+    try:
+
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+        requests = [(file_id, drive_service.files().delete(fileId=file_id)) for file_id in file_ids]
+
+        return_items = {}
+        for file_id, result in gsuite_batch_execute(drive_service, requests).items():
+            if 'error' in result:
+                return_items[file_id] = {'error': str(result['error'])}
+            else:
+                return_items[file_id] = {'response': result['response']}
+                if _DRIVE_CACHE is not None:
+                    _DRIVE_CACHE.remove(drive_user or "", file_id)
+
+        return return_items
+
+    except:
+        raise
+
+def drive_ls_perms_many(sa_secrets_file, ls_perms_ids, drive_user=None):
+
+    try:
+
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+        fields = "nextPageToken, permissions(id, type, emailAddress, role)"
+        requests = [(ls_perms_id, drive_service.permissions().list(pageSize=100, fields=fields, fileId=ls_perms_id)) for ls_perms_id in ls_perms_ids]
+
+        return_items = {}
+        for ls_perms_id, result in gsuite_batch_execute(drive_service, requests).items():
+
+            if 'error' in result:
+                return_items[ls_perms_id] = {'error': str(result['error'])}
+                continue
+
+            # First page comes with batch, files with many permissions are rare, so the rest is listed one by one
+            response = result['response']
+            items = response.get('permissions', [])
+            page_token = response.get('nextPageToken', None)
+            while page_token is not None:
+                response = drive_ls_perms_page(sa_secrets_file, ls_perms_id, page_token, fields, drive_user)
+                items.extend(response.get('permissions', []))
+                page_token = response.get('nextPageToken', None)
+
+            return_items[ls_perms_id] = {'permissions': [{'id': item['id'], 'type': item['type'], 'emailAddress': item.get('emailAddress', ""), 'role': item['role']} for item in items]}
+
+        return return_items
+
+    except:
+        raise
+
+# Existence checks like in drive_mkdir, drive_cp and drive_upload for many (parent ID, name) pairs
+# Returns dict (parent ID, name) -> ID of the first found file or None
+def drive_find_many(sa_secrets_file, pairs, drive_user=None):
+
+    try:
+
+        # Cache answers without API once folder is listed
+        if drive_cache_sync(sa_secrets_file, drive_user) is not None:
+            return dict(((in_id, name), drive_find(sa_secrets_file, in_id, name, drive_user)) for in_id, name in pairs)
+
+        drive_service = gsuite_service(sa_secrets_file, 'drive', 'v3', DRIVE_SCOPES, drive_user)
+
+        requests = []
+        for in_id, name in pairs:
+            requests.append(((in_id, name), drive_service.files().list(pageSize=1, fields="files(id, name)", q=drive_find_query(in_id, name), supportsAllDrives=True, includeItemsFromAllDrives=True)))
+
+        return_items = {}
+        for pair, result in gsuite_batch_execute(drive_service, requests).items():
+            if 'error' in result:
+                raise result['error']
+            items = result['response'].get('files', [])
+            if items:
+                return_items[pair] = items[0]['id']
+            else:
+                return_items[pair] = None
+
+        return return_items
+
+    except:
+        raise
+
+@gsuite_retry
+def sheets_get_as_json(sa_secrets_file, spreadsheet_id, sheet_id, range_id, dimension, render, datetime_render):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        sheet = sheets_service.spreadsheets()
+        result = sheet.values().get(spreadsheetId=spreadsheet_id, range="{0}!{1}".format(sheet_id, range_id), majorDimension=dimension, valueRenderOption=render, dateTimeRenderOption=datetime_render).execute()
+        values = result.get('values', [])
+
+        # Sheets api omits row tail if its values are empty
+        # Pad values to the range size
+
+        return a1_pad_rows(values, sheets_value_range_size(range_id, result['range'], dimension, values))
+
+    except:
+        raise
+
+# Size of rows (or columns with COLUMNS dimension) to pad values to
+# Range returned by API has all bounds, but open bounds of requested range (e.g. A:F) are extended to the whole grid there,
+# so open requested bounds give the longest returned row (or column), as trailing empty rows (or columns) are omitted anyway
+def sheets_value_range_size(requested_range, returned_range, dimension, values):
+
+    try:
+        a1_range = a1_parse(requested_range)
+    except ValueError:
+        a1_range = A1Range(None, requested_range, None, None, None, None)
+
+    if dimension == "COLUMNS":
+        closed = a1_range.first_row is not None and a1_range.last_row is not None
+    else:
+        closed = a1_range.left_column is not None and a1_range.right_column is not None
+
+    # Named range has no bounds in notation, returned range is exactly its bounds
+    if closed or a1_range.name is not None:
+        if dimension == "COLUMNS":
+            return a1_height(a1_parse(returned_range))
+        return a1_width(a1_parse(returned_range))
+
+    return max([len(line) for line in values], default=0)
+
+@gsuite_retry
+def sheets_get_values(sa_secrets_file, spreadsheet_id, range_a1, dimension, render, datetime_render):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        result = sheets_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_a1, majorDimension=dimension, valueRenderOption=render, dateTimeRenderOption=datetime_render).execute()
+
+        return result.get('values', [])
+
+    except:
+        raise
+
+# Returns row count and column count of sheet
+@gsuite_retry
+def sheets_get_grid_size(sa_secrets_file, spreadsheet_id, sheet_id):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        result = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id, ranges=a1_sheet(sheet_id), fields="sheets(properties(gridProperties(rowCount,columnCount)))").execute()
+
+        grid = result['sheets'][0]['properties']['gridProperties']
+
+        return grid['rowCount'], grid['columnCount']
+
+    except:
+        raise
+
+# Generator of range rows padded to range width, for ranges too large for one request
+# Range is read by windows of window_rows rows, not further than the last row of the sheet
+# Width is known before the first window, so open columns (e.g. 2:5) are padded to the sheet column count,
+# not to the longest returned row as sheets_value_range_size does for one request
+# Empty rows between values are yielded as empty padded rows, empty rows after the last values are not, like sheets_get_as_json does
+def sheets_iter_rows(sa_secrets_file, spreadsheet_id, sheet_id, range_id, render, datetime_render, window_rows=SHEETS_WINDOW_ROWS):
+
+    a1_range = a1_parse(range_id)
+    if a1_range.name is not None or a1_range.sheet is not None:
+        raise ValueError("Range {0} should be A1 range within sheet {1}".format(range_id, sheet_id))
+
+    row_count, column_count = sheets_get_grid_size(sa_secrets_file, spreadsheet_id, sheet_id)
+
+    first_row = a1_range.first_row or 1
+    last_row = min(a1_range.last_row or row_count, row_count)
+    left_column = a1_range.left_column or 1
+    right_column = a1_range.right_column or column_count
+
+    range_size = right_column - left_column + 1
+
+    empty_rows = 0
+
+    for window_first_row in range(first_row, last_row + 1, window_rows):
+
+        window_last_row = min(window_first_row + window_rows - 1, last_row)
+        window_range = a1_format(A1Range(sheet_id, None, left_column, window_first_row, right_column, window_last_row))
+
+        values = sheets_get_values(sa_secrets_file, spreadsheet_id, window_range, "ROWS", render, datetime_render)
+
+        for row in values:
+
+            if not row:
+                empty_rows += 1
+                continue
+
+            # Gap before these values
+            for empty_n in range(empty_rows):
+                yield [""] * range_size
+            empty_rows = 0
+
+            if len(row) < range_size:
+                row = row + [""] * (range_size - len(row))
+            yield row
+
+        # Window tail is omitted if empty
+        empty_rows += window_last_row - window_first_row + 1 - len(values)
+
+# Returns number format types (e.g. NUMBER, DATE, DATE_TIME) of cells of one row range, None for cells without format
+@gsuite_retry
+def sheets_get_number_format_types(sa_secrets_file, spreadsheet_id, range_a1):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        result = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id, ranges=range_a1, includeGridData=True, fields="sheets(data(rowData(values(effectiveFormat(numberFormat(type))))))").execute()
+
+        types = []
+        for data in result['sheets'][0].get('data', []):
+            for row_data in data.get('rowData', [])[:1]:
+                for value in row_data.get('values', []):
+                    types.append(value.get('effectiveFormat', {}).get('numberFormat', {}).get('type'))
+
+        return types
+
+    except:
+        raise
+
+# Export range with header in the first row as typed columns to Parquet, Arrow IPC or NPY file
+# Values are read unformatted, so numbers stay numbers, columns formatted as dates in the first data row become datetimes
+# File is written as FILE.part and renamed when complete
+def sheets_export_columns(sa_secrets_file, spreadsheet_id, sheet_id, range_id, output_file, output_format, window_rows=SHEETS_WINDOW_ROWS):
+
+    if output_format not in SHEETS_COLUMNS_FORMATS:
+        raise ValueError("Format {0} is not one of {1}".format(output_format, ", ".join(SHEETS_COLUMNS_FORMATS)))
+
+    a1_range = a1_parse(range_id)
+
+    # First data row is right after header
+    format_row = (a1_range.first_row or 1) + 1
+    if a1_range.left_column is not None:
+        format_range = A1Range(sheet_id, None, a1_range.left_column, format_row, a1_range.right_column, format_row)
+    else:
+        format_range = A1Range(sheet_id, None, None, format_row, None, format_row)
+
+    format_types = sheets_get_number_format_types(sa_secrets_file, spreadsheet_id, a1_format(format_range))
+    date_columns = frozenset([column_n for column_n, format_type in enumerate(format_types) if format_type in SHEETS_DATE_FORMAT_TYPES])
+
+    rows = sheets_iter_rows(sa_secrets_file, spreadsheet_id, sheet_id, range_id, "UNFORMATTED_VALUE", "SERIAL_NUMBER", window_rows)
+    names, columns, types = sheets_columns_from_rows(rows, date_columns)
+
+    part_file = "{0}.part".format(output_file)
+    try:
+        sheets_columns_write(names, columns, types, part_file, output_format)
+    except:
+        # Missing pyarrow or numpy or a full disk should not leave a partial file behind
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+    os.replace(part_file, output_file)
+
+    return {'file': output_file, 'rows': len(columns[0]) if columns else 0, 'columns': dict(zip(names, types))}
+
+# Ranges are A1 ranges with sheet (e.g. Sheet1!A1:F10) or named ranges, all are read with one request
+# Returns dict of range to values, each row (or column with COLUMNS dimension) padded to the range size, see sheets_value_range_size
+@gsuite_retry
+def sheets_batch_get_as_json(sa_secrets_file, spreadsheet_id, ranges, dimension, render, datetime_render):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        result = sheets_service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges, majorDimension=dimension, valueRenderOption=render, dateTimeRenderOption=datetime_render).execute()
+
+        # Value ranges are in the order of requested ranges
+        response = {}
+        for range_id, value_range in zip(ranges, result.get('valueRanges', [])):
+
+            values = value_range.get('values', [])
+            response[range_id] = a1_pad_rows(values, sheets_value_range_size(range_id, value_range['range'], dimension, values))
+
+        return response
+
+    except:
+        raise
+
+# Data is JSON dict of range to values (list of rows or columns), all ranges are written with one request
+@gsuite_retry
+def sheets_batch_update_data(sa_secrets_file, spreadsheet_id, dimension, json_str):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        json_dict = json.loads(json_str)
+
+        request = {
+            "valueInputOption": "USER_ENTERED",
+            "data": [{"range": range_id, "majorDimension": dimension, "values": json_dict[range_id]} for range_id in json_dict]
+        }
+
+        response = sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=request).execute()
+
+        return response
+
+    except:
+        raise
+
+@gsuite_retry
+def sheets_append_data(sa_secrets_file, spreadsheet_id, sheet_id, range_id, dimension, json_str):
+
+    try:
+
+        sheets_service = gsuite_service(sa_secrets_file, 'sheets', 'v4', SHEETS_SCOPES)
+
+        json_dict = json.loads(json_str)
+        
+        request = {
+            "majorDimension": dimension,
+            "values": json_dict
+        }
+
+        response = sheets_service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range="{0}!{1}".format(sheet_id, range_id), valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS", body=request).execute()
+
+        return response
+
+    except:
+        raise
+
+_SHEETS_APPEND_LOGGER = logging.getLogger(__name__)
+
+# In-process append buffer, rows for the same spreadsheet, sheet and range are sent with one append
+# Range is flushed when it has max_rows rows or its oldest rows wait max_age seconds (checked by background thread), and on close
+# Rows which failed to append stay in buffer and are sent with the next flush
+class SheetsAppendBuffer(object):
+
+    def __init__(self, sa_secrets_file, max_rows=SHEETS_APPEND_MAX_ROWS, max_age=SHEETS_APPEND_MAX_AGE):
+        self.sa_secrets_file = sa_secrets_file
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.buffers = {}
+        self.closed = threading.Event()
+        self.timer = None
+        self.last_error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, spreadsheet_id, sheet_id, range_id, dimension, values):
+
+        key = (spreadsheet_id, sheet_id, range_id)
+
+        with self.lock:
+            if self.closed.is_set():
+                raise ValueError("Append buffer is closed")
+            if key not in self.buffers:
+                self.buffers[key] = {'rows': [], 'since': time.monotonic()}
+            self.buffers[key]['rows'].extend(sheets_values_rows(dimension, values))
+            full = len(self.buffers[key]['rows']) >= self.max_rows
+            if self.timer is None:
+                self.timer = threading.Thread(target=self._flush_aged, daemon=True)
+                self.timer.start()
+
+        # Rows are accepted once buffered, failed flush must not make caller add them again
+        if full:
+            self._flush_kept(key)
+
+    # Failed rows are kept in buffer and flushed again by timer or close, error is logged and kept in last_error
+    def _flush_kept(self, key):
+        try:
+            self.flush(key)
+        except Exception as e:
+            self.last_error = e
+            _SHEETS_APPEND_LOGGER.warning("Append to {0} failed, rows are kept in buffer: {1}".format(key, e))
+
+    def _flush_aged(self):
+        while not self.closed.wait(min(1, self.max_age)):
+            now = time.monotonic()
+            with self.lock:
+                aged = [key for key in self.buffers if now - self.buffers[key]['since'] >= self.max_age]
+            for key in aged:
+                self._flush_kept(key)
+
+    # Flush one range or all of them
+    def flush(self, key=None):
+
+        # One flush at a time keeps order of rows of the same range
+        with self.flush_lock:
+
+            with self.lock:
+                if key is None:
+                    keys = list(self.buffers)
+                else:
+                    keys = [key] if key in self.buffers else []
+                taken = dict([(taken_key, self.buffers.pop(taken_key)) for taken_key in keys])
+
+            for key_n, key in enumerate(keys):
+
+                spreadsheet_id, sheet_id, range_id = key
+                rows = taken[key]['rows']
+                sent = 0
 
-        if 'messages' in response:
+                try:
+                    while sent < len(rows):
+                        chunk = rows[sent:sent + self.max_rows]
+                        sheets_append_data(self.sa_secrets_file, spreadsheet_id, sheet_id, range_id, "ROWS", json.dumps(chunk))
+                        sent += len(chunk)
+                except:
+                    # Put back what was not sent, before rows added meanwhile
+                    with self.lock:
+                        for unsent_key in keys[key_n:]:
+                            unsent_rows = taken[unsent_key]['rows']
+                            if unsent_key == key:
+                                unsent_rows = unsent_rows[sent:]
+                            buffered = self.buffers.pop(unsent_key, {'rows': []})
+                            self.buffers[unsent_key] = {'rows': unsent_rows + buffered['rows'], 'since': taken[unsent_key]['since']}
+                    raise
+
+    def close(self):
+        self.closed.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+
+# Write rows to spool directory instead of sending them, see sheets_spool.py
+def sheets_spool_data(spreadsheet_id, sheet_id, range_id, dimension, json_str, spool_dir=SHEETS_SPOOL_DIR):
+
+    return SheetsSpool(spool_dir).write(spreadsheet_id, sheet_id, range_id, dimension, json.loads(json_str))
+
+# Send spooled rows, coalesced into appends of up to max_rows rows per spreadsheet, sheet and range
+# Ranges with fewer than max_rows rows written less than max_age seconds ago are left for the next flush
+# Returns list of results per range, or None if another flusher is working with spool
+def sheets_flush_spool(sa_secrets_file, spool_dir=SHEETS_SPOOL_DIR, max_age=0, max_rows=SHEETS_APPEND_MAX_ROWS):
+
+    spool = SheetsSpool(spool_dir)
+
+    if not spool.lock_flush():
+        return None
+
+    try:
+
+        results = []
+        now = time.time()
+
+        pending = spool.pending()
+
+        for key in pending:
+
+            spreadsheet_id, sheet_id, range_id = key
+            entries = pending[key]
+            result = {'spreadsheet_id': spreadsheet_id, 'sheet_id': sheet_id, 'range_id': range_id, 'rows': 0, 'files': 0}
+
+            if sum([len(rows) for name, rows, written in entries]) < max_rows and now - entries[0][2] < max_age:
+                continue
+
+            try:
+
+                names = []
+                rows_chunk = []
+
+                for n, (name, rows, written) in enumerate(entries):
+
+                    names.append(name)
+                    rows_chunk.extend(rows)
+
+                    if len(rows_chunk) >= max_rows or n == len(entries) - 1:
+                        if rows_chunk:
+                            sheets_append_data(sa_secrets_file, spreadsheet_id, sheet_id, range_id, "ROWS", json.dumps(rows_chunk))
+                        spool.remove(names)
+                        result['rows'] += len(rows_chunk)
+                        result['files'] += len(names)
+                        names = []
+                        rows_chunk = []
+
+            except Exception as e:
+                # Other ranges are independent
+                result['error'] = str(e)
+
+            results.append(result)
+
+        return results
+
+    finally:
+        spool.unlock_flush()
+
+# Encoded attachments shared by all drafts of the process, disabled by GMAIL_ATTACHMENT_CACHE_BYTES env set to 0
+if GMAIL_ATTACHMENT_CACHE_BYTES > 0:
+    _GMAIL_ATTACHMENT_CACHE = GmailAttachmentCache(GMAIL_ATTACHMENT_CACHE_BYTES)
+else:
+    _GMAIL_ATTACHMENT_CACHE = None
+
+# Messages with attachments are written to temp file with attachments streamed from disk and uploaded as media,
+# so memory does not grow with attachment size and the 5 MB limit of raw body does not apply
+@gsuite_retry
+def gmail_create_draft(sa_secrets_file, gmail_user, message_from, message_to, message_cc, message_bcc, message_subject, message_text, attach_str):
+
+    try:
+
+        gmail_service = gsuite_service(sa_secrets_file, 'gmail', 'v1', GMAIL_SCOPES, gmail_user)
+
+        message_text_new_lines = message_text.replace('\\n', '\n')
+        attach_list = json.loads(attach_str)
+
+        if not attach_list:
+
+            message = gmail_mime_message(message_from, message_to, message_cc, message_bcc, message_subject, message_text_new_lines)
+
+            b64_bytes = base64.urlsafe_b64encode(message.as_bytes())
+            b64_string = b64_bytes.decode()
+            message_body = {'raw': b64_string}
+            message = {'message': message_body}
+            draft = gmail_service.users().drafts().create(userId='me', body=message).execute()
+
+            return draft['id'], draft['message']
+
+        if not os.path.isdir(GMAIL_MIME_DIR):
+            os.makedirs(GMAIL_MIME_DIR, 0o700, exist_ok=True)
+
+        message_file, message_file_name = tempfile.mkstemp(suffix=".eml", dir=GMAIL_MIME_DIR)
+
+        try:
+
+            with os.fdopen(message_file, "wb") as f:
+                gmail_mime_write(f, message_from, message_to, message_cc, message_bcc, message_subject, message_text_new_lines, attach_list, _GMAIL_ATTACHMENT_CACHE)
+
+            media = MediaFileUpload(message_file_name, mimetype="message/rfc822", chunksize=GMAIL_UPLOAD_CHUNK_SIZE, resumable=True)
+            request = gmail_service.users().drafts().create(userId='me', body={}, media_body=media)
+
+            draft = None
+            while draft is None:
+                status, draft = request.next_chunk()
+
+        finally:
+            os.remove(message_file_name)
+
+        return draft['id'], draft['message']
+
+    except:
+        raise
+
+# One page of messages().list, retried separately, so a failure does not restart listing
+@gsuite_retry
+def gmail_list_page(sa_secrets_file, gmail_user, page_token, query=None, label_ids=None, page_size=GMAIL_PAGE_SIZE):
+
+    try:
+
+        gmail_service = gsuite_service(sa_secrets_file, 'gmail', 'v1', GMAIL_SCOPES, gmail_user)
 
-            for msg in response['messages']:
+        return gmail_service.users().messages().list(userId=gmail_user, pageToken=page_token, q=query, labelIds=label_ids, maxResults=page_size, fields="nextPageToken,messages(id,threadId)").execute()
+
+    except:
+        raise
+
+# Message metadata as flat dict, headers are lower case keys
+def gmail_message_metadata(message):
+
+    item = {
+        'id': message['id'],
+        'threadId': message.get('threadId'),
+        'labelIds': message.get('labelIds', []),
+        'snippet': message.get('snippet', ""),
+        'internalDate': message.get('internalDate'),
+        'sizeEstimate': message.get('sizeEstimate')
+    }
+
+    for header in message.get('payload', {}).get('headers', []):
+        if header['name'] in GMAIL_METADATA_HEADERS:
+            item[header['name'].lower()] = header['value']
+
+    return item
+
+# Metadata of messages by IDs with batch requests, messages deleted meanwhile are omitted
+# Returns dict of ID to metadata
+# Not retried as a whole, gsuite_batch_execute retries failed items and batches
+def gmail_get_metadata_many(sa_secrets_file, gmail_user, message_ids):
+
+    try:
+
+        gmail_service = gsuite_service(sa_secrets_file, 'gmail', 'v1', GMAIL_SCOPES, gmail_user)
+
+        requests = [(message_id, gmail_service.users().messages().get(userId=gmail_user, id=message_id, format='metadata', metadataHeaders=GMAIL_METADATA_HEADERS, fields=GMAIL_METADATA_FIELDS)) for message_id in message_ids]
+
+        return_items = {}
+        for message_id, result in gsuite_batch_execute(gmail_service, requests, GMAIL_BATCH_SIZE).items():
+            if 'error' in result:
+                if isinstance(result['error'], HttpError) and result['error'].resp.status == 404:
+                    continue
+                raise result['error']
+            return_items[message_id] = gmail_message_metadata(result['response'])
+
+        return return_items
+
+    except:
+        raise
+
+# Generator of message metadata in listing order, all pages
+# Metadata of every page is fetched by batches of GMAIL_BATCH_SIZE on up to workers threads, while the next page is listed
+# query is Gmail search query (e.g. 'from:a@example.com newer_than:7d'), label_ids is list of label IDs, all of them should match
+def gmail_iter_messages(sa_secrets_file, gmail_user, query=None, label_ids=None, workers=GMAIL_WORKERS):
+
+    with ThreadPoolExecutor(max_workers=workers + 1) as executor:
+
+        page_future = executor.submit(gmail_list_page, sa_secrets_file, gmail_user, None, query, label_ids)
+
+        while page_future is not None:
+
+            response = page_future.result()
+            page_token = response.get('nextPageToken', None)
+
+            if page_token is not None:
+                page_future = executor.submit(gmail_list_page, sa_secrets_file, gmail_user, page_token, query, label_ids)
+            else:
+                page_future = None
+
+            message_ids = [msg['id'] for msg in response.get('messages', [])]
+            chunks = [message_ids[start:start + GMAIL_BATCH_SIZE] for start in range(0, len(message_ids), GMAIL_BATCH_SIZE)]
+            chunk_futures = [executor.submit(gmail_get_metadata_many, sa_secrets_file, gmail_user, chunk) for chunk in chunks]
+
+            for chunk, chunk_future in zip(chunks, chunk_futures):
+                metadata = chunk_future.result()
+                for message_id in chunk:
+                    if message_id in metadata:
+                        yield metadata[message_id]
+
+# Returns list of message dicts (id, threadId) each followed by its snippet
+def gmail_list_messages(sa_secrets_file, gmail_user, query=None, label_ids=None):
+
+    try:
+
+        return_list = []
+
+        for item in gmail_iter_messages(sa_secrets_file, gmail_user, query, label_ids):
+            return_list.append({'id': item['id'], 'threadId': item['threadId']})
+            return_list.append(item['snippet'])
 
-                message = gmail_service.users().messages().get(userId=gmail_user, id=msg['id'], format='raw').execute()
-                return_list.append(msg)
-                return_list.append(message['snippet'])
-            
         return return_list
 
     except:
         raise
 
-@retry(stop_max_attempt_number=GSUITE_RETRIES)
+# Incremental sync state, last seen historyId per user
+
+def gmail_state_file(gmail_user, state_dir=GMAIL_STATE_DIR):
+    return os.path.join(state_dir, "{0}.json".format(hashlib.sha1(gmail_user.lower().encode("utf-8")).hexdigest()))
+
+def gmail_state_load(gmail_user, state_dir=GMAIL_STATE_DIR):
+
+    try:
+        with open(gmail_state_file(gmail_user, state_dir), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+# Written to temp file and renamed, so interrupted write never leaves broken state
+def gmail_state_save(gmail_user, state, state_dir=GMAIL_STATE_DIR):
+
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, 0o700, exist_ok=True)
+
+    state_file = gmail_state_file(gmail_user, state_dir)
+    tmp_file = "{0}.{1}.tmp".format(state_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, state_file)
+
+@gsuite_retry
+def gmail_get_history_id(sa_secrets_file, gmail_user):
+
+    try:
+
+        gmail_service = gsuite_service(sa_secrets_file, 'gmail', 'v1', GMAIL_SCOPES, gmail_user)
+
+        return gmail_service.users().getProfile(userId=gmail_user, fields="historyId").execute()['historyId']
+
+    except:
+        raise
+
+# One page of history().list, HttpError 404 means start history ID is too old
+@gsuite_retry
+def gmail_history_page(sa_secrets_file, gmail_user, start_history_id, page_token):
+
+    try:
+
+        gmail_service = gsuite_service(sa_secrets_file, 'gmail', 'v1', GMAIL_SCOPES, gmail_user)
+
+        fields = "nextPageToken,historyId,history(messagesAdded(message(id)),messagesDeleted(message(id)))"
+        return gmail_service.users().history().list(userId=gmail_user, startHistoryId=start_history_id, historyTypes=['messageAdded', 'messageDeleted'], pageToken=page_token, maxResults=GMAIL_PAGE_SIZE, fields=fields).execute()
+
+    except:
+        raise
+
+# Generator of mailbox changes since the previous sync of user, as dicts with event key:
+#   added   - message metadata, the same as gmail_iter_messages yields
+#   deleted - only id
+#   resync  - no previous state or its history is expired, all messages follow as added
+# New state is saved after the last change is yielded, so changes of interrupted sync are yielded again by the next one
+def gmail_sync_messages(sa_secrets_file, gmail_user, state_dir=GMAIL_STATE_DIR, workers=GMAIL_WORKERS):
+
+    state = gmail_state_load(gmail_user, state_dir)
+
+    added = None
+
+    if state is not None:
+
+        # Message added and deleted within the same period is reported as deleted only
+        added = {}
+        deleted = {}
+        page_token = None
+
+        try:
+
+            while True:
+
+                response = gmail_history_page(sa_secrets_file, gmail_user, state['historyId'], page_token)
+
+                for history in response.get('history', []):
+                    for change in history.get('messagesAdded', []):
+                        added[change['message']['id']] = True
+                        deleted.pop(change['message']['id'], None)
+                    for change in history.get('messagesDeleted', []):
+                        added.pop(change['message']['id'], None)
+                        deleted[change['message']['id']] = True
+
+                history_id = response.get('historyId', state['historyId'])
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    break
+
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            added = None
+
+    if added is None:
+
+        # History ID is taken before listing, so nothing added during listing is missed by the next sync
+        history_id = gmail_get_history_id(sa_secrets_file, gmail_user)
+
+        yield {'event': "resync"}
+
+        for item in gmail_iter_messages(sa_secrets_file, gmail_user, workers=workers):
+            item['event'] = "added"
+            yield item
+
+    else:
+
+        for message_id in deleted:
+            yield {'event': "deleted", 'id': message_id}
+
+        message_ids = list(added)
+        for start in range(0, len(message_ids), GMAIL_PAGE_SIZE):
+            chunk = message_ids[start:start + GMAIL_PAGE_SIZE]
+            metadata = gmail_get_metadata_many(sa_secrets_file, gmail_user, chunk)
+            for message_id in chunk:
+                if message_id in metadata:
+                    item = metadata[message_id]
+                    item['event'] = "added"
+                    yield item
+
+    gmail_state_save(gmail_user, {'user': gmail_user, 'historyId': history_id, 'synced_at': time.time()}, state_dir)
+
+@gsuite_retry
 def gmail_send_draft(sa_secrets_file, gmail_user, draft_id):
 
     try:
 
-        credentials = service_account.Credentials.from_service_account_file(sa_secrets_file, scopes=GMAIL_SCOPES)
-        delegated_credentials = credentials.with_subject(gmail_user)
-        gmail_service = build('gmail', 'v1', credentials=delegated_credentials)
+        gmail_service = gsuite_service(sa_secrets_file, 'gmail', 'v1', GMAIL_SCOPES, gmail_user)
 
         body = {'id': draft_id}
         message = gmail_service.users().drafts().send(userId='me', body=body).execute()
@@ -669,3 +2098,196 @@ def gmail_send_draft(sa_secrets_file, gmail_user, draft_id):
 
     except:
         raise
+
+# Create draft of one bulk row and optionally send it
+# Row is a dict with user, from, to, subject, text and optional cc, bcc, attach (list or JSON list of local files)
+# Row with draft_id (e.g. created by previous run without sending) is only sent
+def gmail_draft_row(sa_secrets_file, row, send=False):
+
+    try:
+
+        result = {}
+
+        draft_id = row.get('draft_id')
+
+        if not draft_id:
+
+            attach_list = row.get('attach') or []
+            if isinstance(attach_list, str):
+                attach_list = json.loads(attach_list)
+
+            draft_id, draft_message = gmail_create_draft(sa_secrets_file, row['user'], row['from'], row['to'], row.get('cc') or "", row.get('bcc') or "", row['subject'], row['text'], json.dumps(attach_list))
+            result['message'] = draft_message['id']
+
+        result['draft'] = draft_id
+        result['status'] = "created"
+
+        if send:
+            try:
+                message = gmail_send_draft(sa_secrets_file, row['user'], draft_id)
+            except Exception as e:
+                # Draft id is returned with failure, so that rerun sends this draft instead of creating another one
+                result['status'] = "failed"
+                result['error'] = str(e)
+                return result
+            result['message'] = message['id']
+            result['status'] = "sent"
+
+        return result
+
+    except:
+        raise
+
+# Create (and send) drafts of many rows concurrently, rows is an iterable of (row number, row dict), see gmail_draft_row
+# Up to workers rows are processed at once, but no more than user_workers for the same gmail user, as Gmail limits concurrent requests per user
+# Rows of other users are not held up by a busy user: up to read_ahead rows are read from rows and queued per user
+# Yields (row number, result) in order of completion, failed rows have 'status' failed and 'error' with error message
+def gmail_drafts_many(sa_secrets_file, rows, send=False, workers=GMAIL_DRAFTS_WORKERS, user_workers=GMAIL_DRAFTS_USER_WORKERS, read_ahead=GMAIL_DRAFTS_READ_AHEAD):
+
+    rows = iter(rows)
+    rows_left = True
+    queues = {}
+    queued = 0
+    running = {}
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        while True:
+
+            while rows_left and queued < read_ahead:
+                try:
+                    row_n, row = next(rows)
+                except StopIteration:
+                    rows_left = False
+                    break
+                queues.setdefault(row.get('user'), deque()).append((row_n, row))
+                queued += 1
+
+            for gmail_user in list(queues):
+                queue = queues[gmail_user]
+                while queue and len(futures) < workers and running.get(gmail_user, 0) < user_workers:
+                    row_n, row = queue.popleft()
+                    queued -= 1
+                    running[gmail_user] = running.get(gmail_user, 0) + 1
+                    futures[executor.submit(gmail_draft_row, sa_secrets_file, row, send)] = (row_n, gmail_user)
+                if not queue:
+                    del queues[gmail_user]
+
+            # Nothing running means every queued row would have been submitted, so all rows are done
+            if not futures:
+                break
+
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                row_n, gmail_user = futures.pop(future)
+                running[gmail_user] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'status': "failed", 'error': str(e)}
+                yield row_n, result
+
+# Status file has one JSON line per finished item (merge.py --status, gmail.py --result), appended as items finish
+# Returns dict of item key field value to the last status line of the item
+def batch_status_load(status_file, key):
+
+    statuses = {}
+
+    if status_file is None or not os.path.exists(status_file):
+        return statuses
+
+    with open(status_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                status = json.loads(line)
+            except ValueError:
+                # Line cut by interrupted run
+                continue
+            statuses[status[key]] = status
+
+    return statuses
+
+_BATCH_LOGGER = logging.getLogger(__name__)
+
+# Whole per document pipeline: copy template, fill it, export pdf, create draft with pdf attached
+# Document is a dict from batch manifest, see README
+# Copy is made as NAME.part and renamed to NAME when it is complete, right before draft, so only complete documents have their names
+# Unfinished copy left by failed or killed run is removed and made again by the next run
+# With cleanup, copy is also removed right away if anything fails after copying, including draft, so rerun makes document and draft again
+# found is optional dict (folder, name) -> ID or None from drive_find_many, checked for NAME and NAME.part instead of one lookup each
+def batch_document(sa_secrets_file, document, cleanup=False, found=None):
+
+    doc_id = None
+
+    try:
+
+        drive_user = document.get('user')
+        result = {
+            'name': document['name']
+        }
+
+        def find(name):
+            if found is not None and (document['folder'], name) in found:
+                return found[(document['folder'], name)]
+            return drive_find(sa_secrets_file, document['folder'], name, drive_user)
+
+        # Already generated by previous run, nothing to do
+        if find(document['name']) is not None:
+            result['status'] = "exists"
+            return result
+
+        part_name = BATCH_PART_NAME.format(document['name'])
+
+        part_id = find(part_name)
+        if part_id is not None:
+            drive_rm(sa_secrets_file, part_id, drive_user)
+
+        doc_id = drive_cp(sa_secrets_file, document['template'], document['folder'], part_name, drive_user)
+
+        # Made by concurrent run in the meantime
+        if doc_id is None:
+            raise Exception("Document {0} is being generated by another run".format(part_name))
+
+        result['id'] = doc_id
+
+        # All edits in one batchUpdate
+        plan = {}
+        for key in ['replace_all_text', 'insert_table_rows', 'delete_table_rows']:
+            if document.get(key):
+                plan[key] = document[key]
+
+        if plan:
+            docs_apply_edit_plan(sa_secrets_file, doc_id, json.dumps(plan))
+
+        if document.get('pdf'):
+            drive_pdf(sa_secrets_file, doc_id, document['pdf'], drive_user)
+            result['pdf'] = document['pdf']
+
+        # Renamed before draft, so that failed rename does not leave a draft which rerun would create again
+        # If draft fails, document is removed by cleanup and rerun makes both
+        drive_rename(sa_secrets_file, doc_id, document['folder'], document['name'], drive_user)
+
+        if document.get('draft'):
+
+            draft = document['draft']
+            attach_list = list(draft.get('attach', []))
+            if document.get('pdf'):
+                attach_list.append(document['pdf'])
+
+            draft_id, draft_message = gmail_create_draft(sa_secrets_file, draft['user'], draft['from'], draft['to'], draft.get('cc', ""), draft.get('bcc', ""), draft['subject'], draft['text'], json.dumps(attach_list))
+            result['draft'] = draft_id
+
+        result['status'] = "done"
+
+        return result
+
+    except:
+        if cleanup and doc_id is not None:
+            # Error of removal should not hide error of generation, copy left behind is removed by rerun if it is still .part
+            try:
+                drive_rm(sa_secrets_file, doc_id, document.get('user'))
+            except Exception as e:
+                _BATCH_LOGGER.warning("Removing {0} of failed document {1} failed: {2}".format(doc_id, document['name'], e))
+        raise
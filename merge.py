@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Import common code
+from sysadmws_common import *
+from gsuite_scripts import *
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+
+# Constants
+LOGO="G Suite Scripts / Merge"
+LOG_DIR = os.environ.get("LOG_DIR")
+if LOG_DIR is None:
+    LOG_DIR = "log"
+LOG_FILE = "merge.log"
+SA_SECRETS_FILE = os.environ.get("SA_SECRETS_FILE")
+MERGE_WORKERS = 4
+MERGE_PLACEHOLDER = "__{0}__"
+
+# Data sources yield records as dicts of field name to value, numbered from 1
+
+def merge_records_csv(csv_file):
+
+    with open(csv_file, "r", newline="", encoding="utf-8") as f:
+        for record_n, record in enumerate(csv.DictReader(f), 1):
+            yield record_n, record
+
+def merge_records_jsonl(jsonl_file):
+
+    with open(jsonl_file, "r", encoding="utf-8") as f:
+        record_n = 0
+        for line in f:
+            if not line.strip():
+                continue
+            record_n += 1
+            yield record_n, json.loads(line)
+
+# First row of the range is header with field names, empty rows are skipped
+def merge_records_sheet(spreadsheet_id, sheet_id, range_id):
+
+    values = sheets_get_as_json(SA_SECRETS_FILE, spreadsheet_id, sheet_id, range_id, "ROWS", "FORMATTED_VALUE", "FORMATTED_STRING")
+
+    if not values:
+        return
+
+    header = values[0]
+    record_n = 0
+    for row in values[1:]:
+        if not any(row):
+            continue
+        record_n += 1
+        yield record_n, dict(zip(header, row))
+
+# Records done by previous runs according to status file are skipped
+def merge_status_done(status_file):
+
+    statuses = batch_status_load(status_file, 'record')
+
+    return set(record_n for record_n, status in statuses.items() if status.get('status') in ["done", "exists"])
+
+# Turn record into batch manifest document
+# Fields used for table rows are JSON lists of rows (or lists already in JSON Lines), all other fields are replacements
+def merge_document(args, record):
+
+    document = {
+        'template': args.template[0],
+        'folder': args.folder[0],
+        'name': args.name[0].format_map(record)
+    }
+
+    if args.user:
+        document['user'] = args.user[0]
+
+    table_fields = set()
+
+    if args.insert_table_rows:
+        document['insert_table_rows'] = []
+        for table_num, below_row_number, field in args.insert_table_rows:
+            rows = record.get(field) or []
+            if isinstance(rows, str):
+                rows = json.loads(rows)
+            if rows:
+                document['insert_table_rows'].append({'table_num': int(table_num), 'below_row_number': int(below_row_number), 'rows': [[str(cell) for cell in row] for row in rows]})
+            table_fields.add(field)
+
+    if args.delete_table_row:
+        document['delete_table_rows'] = [{'table_num': int(table_num), 'row_number': int(row_number)} for table_num, row_number in args.delete_table_row]
+
+    replacements = {}
+    for field in record:
+        if field in table_fields or field is None:
+            continue
+        value = record[field]
+        if value is None:
+            value = ""
+        replacements[args.placeholder[0].format(field)] = str(value)
+    document['replace_all_text'] = replacements
+
+    if args.pdf:
+        document['pdf'] = args.pdf[0].format_map(record)
+
+    return document
+
+# Main
+
+def main(argv=None):
+
+    # Set parser and parse args
+    parser = argparse.ArgumentParser(description='Script to generate documents from one template for every record of CSV, JSON Lines or sheet range (copy template, fill, export pdf).')
+    parser.add_argument("--debug",              dest="debug",               help="enable debug",                        action="store_true")
+    parser.add_argument("--template",           dest="template",            help="google drive doc ID of template",     nargs=1,    metavar=("ID"),     required=True)
+    parser.add_argument("--folder",             dest="folder",              help="google drive folder CD to put documents into",   nargs=1,    metavar=("CD"),     required=True)
+    name_help = "document NAME with record fields in braces (e.g. 'Invoice {NUMBER}'), documents which already exist are skipped"
+    parser.add_argument("--name",               dest="name",                help=name_help,                             nargs=1,    metavar=("NAME"),   required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv",                dest="csv",                 help="records from CSV FILE with header",   nargs=1,    metavar=("FILE"))
+    source.add_argument("--jsonl",              dest="jsonl",               help="records from JSON Lines FILE",        nargs=1,    metavar=("FILE"))
+    sheet_help = "records from RANGE of SHEET of google sheet ID, first row is header"
+    source.add_argument("--sheet",              dest="sheet",               help=sheet_help,                            nargs=3,    metavar=("ID", "SHEET", "RANGE"))
+    placeholder_help = "template text replaced by record field, {{0}} is field name, '{0}' by default".format(MERGE_PLACEHOLDER)
+    parser.add_argument("--placeholder",        dest="placeholder",         help=placeholder_help,                      nargs=1,    metavar=("PATTERN"),    default=[MERGE_PLACEHOLDER])
+    insert_table_rows_help = "insert rows from record FIELD (JSON e.g. '[[\"Cell 1-1\", \"Cell 1-2\"]]') into TABLE_NUM below row number BELOW_ROW_NUMBER of template, could be repeated"
+    parser.add_argument("--insert-table-rows",  dest="insert_table_rows",   help=insert_table_rows_help,                nargs=3,    metavar=("TABLE_NUM", "BELOW_ROW_NUMBER", "FIELD"),  action="append")
+    delete_table_row_help = "delete row ROW_NUMBER of template from TABLE_NUM, could be repeated"
+    parser.add_argument("--delete-table-row",   dest="delete_table_row",    help=delete_table_row_help,                 nargs=2,    metavar=("TABLE_NUM", "ROW_NUMBER"),  action="append")
+    parser.add_argument("--pdf",                dest="pdf",                 help="export every document to local pdf FILE with record fields in braces",  nargs=1,    metavar=("FILE"))
+    parser.add_argument("--user",               dest="user",                help="impersonate google drive USER",       nargs=1,    metavar=("USER"))
+    workers_help = "process up to N records concurrently, {0} by default".format(MERGE_WORKERS)
+    parser.add_argument("--workers",            dest="workers",             help=workers_help,                          nargs=1,    metavar=("N"),      type=int,   default=[MERGE_WORKERS])
+    status_help = "append status JSON line of every record to FILE and skip records done according to it, to restart interrupted merge"
+    parser.add_argument("--status",             dest="status",              help=status_help,                           nargs=1,    metavar=("FILE"))
+    args = parser.parse_args(argv)
+
+    # Set logger and console debug
+    if args.debug:
+        logger = set_logger(logging.DEBUG, LOG_DIR, LOG_FILE)
+    else:
+        logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
+
+    # Catch exception to logger
+
+    try:
+
+        logger.info(LOGO)
+        logger.info("Starting script")
+
+        # Check env vars and connects
+        if SA_SECRETS_FILE is None:
+            raise Exception("Env var SA_SECRETS_FILE missing")
+
+        if args.csv:
+            records = merge_records_csv(args.csv[0])
+        elif args.jsonl:
+            records = merge_records_jsonl(args.jsonl[0])
+        else:
+            records = merge_records_sheet(*args.sheet)
+
+        status_file = args.status[0] if args.status else None
+        done = merge_status_done(status_file)
+
+        # Do tasks
+        # Records are independent, failed record does not stop others
+        # Failed document copy is removed, so restart generates it again
+        # At most 2 * workers records are read ahead, so data source is streamed
+
+        workers, = args.workers
+        failed = 0
+        total = 0
+
+        status_out = None
+        if status_file is not None:
+            status_out = open(status_file, "a", encoding="utf-8")
+
+        def report(status):
+            line = json.dumps(status)
+            print(line, flush=True)
+            logger.info(line)
+            if status_out is not None:
+                status_out.write(line + "\n")
+                status_out.flush()
+
+        def record_done(future, record_n):
+            nonlocal failed
+            status = {'record': record_n}
+            try:
+                status.update(future.result())
+            except Exception as e:
+                logger.exception(e)
+                status.update({'status': "failed", 'error': str(e)})
+                failed += 1
+            report(status)
+
+        def record_merge(record_n, document):
+            try:
+                result = batch_document(SA_SECRETS_FILE, document, cleanup=True)
+            except Exception as e:
+                raise Exception('Record {0} document {1} failed: {2}'.format(record_n, document['name'], e))
+            return result
+
+        try:
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+
+                futures = {}
+
+                for record_n, record in records:
+
+                    if record_n in done:
+                        continue
+
+                    total += 1
+
+                    try:
+                        document = merge_document(args, record)
+                    except Exception as e:
+                        logger.exception(e)
+                        failed += 1
+                        report({'record': record_n, 'status': "failed", 'error': 'Record {0} is invalid: {1}'.format(record_n, e)})
+                        continue
+
+                    futures[executor.submit(record_merge, record_n, document)] = record_n
+
+                    if len(futures) >= 2 * workers:
+                        for future in as_completed(futures):
+                            record_done(future, futures.pop(future))
+                            break
+
+                for future in as_completed(futures):
+                    record_done(future, futures[future])
+
+        finally:
+            if status_out is not None:
+                status_out.close()
+
+        if failed:
+            raise Exception('{0} of {1} records failed'.format(failed, total))
+
+    # Reroute catched exception to log
+    except Exception as e:
+        logger.exception(e)
+        logger.info("Finished script with errors")
+        return 1
+
+    logger.info("Finished script")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@
 # Import common code
 from sysadmws_common import *
 from gsuite_scripts import *
+import csv
 
 # Constants
 LOGO="G Suite Scripts / Sheets"
@@ -12,25 +13,54 @@ if LOG_DIR is None:
     LOG_DIR = "log"
 LOG_FILE = "sheets.log"
 SA_SECRETS_FILE = os.environ.get("SA_SECRETS_FILE")
+OUTPUT_FORMATS = ["jsonl", "csv"]
 
 # Main
 
-if __name__ == "__main__":
+def main(argv=None):
 
     # Set parser and parse args
     parser = argparse.ArgumentParser(description='Script to automate specific operations with G Suite Docs.')
     parser.add_argument("--debug",              dest="debug",               help="enable debug",                        action="store_true")
+    format_help = "output format of rows streamed by --get-rows: jsonl (default) or csv"
+    parser.add_argument("--format",             dest="format",              help=format_help,                           nargs=1,    metavar=("FORMAT"), choices=OUTPUT_FORMATS)
+    window_rows_help = "read --get-rows and --export range by windows of N rows, {0} by default".format(SHEETS_WINDOW_ROWS)
+    parser.add_argument("--window-rows",        dest="window_rows",         help=window_rows_help,                      nargs=1,    metavar=("N"),      type=int)
+    spool_dir_help = "spool directory DIR for --spool-data and --flush-spool, SHEETS_SPOOL_DIR env or {0} by default".format(SHEETS_SPOOL_DIR)
+    parser.add_argument("--spool-dir",          dest="spool_dir",           help=spool_dir_help,                        nargs=1,    metavar=("DIR"))
+    watch_help = "keep flushing spool with --flush-spool every SECONDS until interrupted"
+    parser.add_argument("--watch",              dest="watch",               help=watch_help,                            nargs=1,    metavar=("SECONDS"),    type=float)
     group = parser.add_mutually_exclusive_group(required=True)
     get_as_json_help = """get google drive spreadsheet ID range RANGE on sheet SHEET as json, use
                           DIMENSION = 'ROWS' or 'COLUMNS',
                           RENDER = 'FORMATTED_VALUE' or 'UNFORMATTED_VALUE' or 'FORMULA',
                           DATETIME_RENDER = 'SERIAL_NUMBER' or 'FORMATTED_STRING'"""
     group.add_argument("--get-as-json",         dest="get_as_json",         help=get_as_json_help,                      nargs=6,    metavar=("ID", "SHEET", "RANGE", "DIMENSION", "RENDER", "DATETIME_RENDER"))
+    get_rows_help = """stream rows of google drive spreadsheet ID range RANGE (e.g. A:F or A2:F) on sheet SHEET as JSON Lines or CSV,
+                       range is read by windows of rows up to the last row of the sheet,
+                       RENDER and DATETIME_RENDER are the same as for --get-as-json"""
+    group.add_argument("--get-rows",            dest="get_rows",            help=get_rows_help,                         nargs=5,    metavar=("ID", "SHEET", "RANGE", "RENDER", "DATETIME_RENDER"))
+    export_help = """export google drive spreadsheet ID range RANGE on sheet SHEET with header in the first row to FILE as typed columns,
+                     FORMAT = 'parquet' or 'arrow' (Arrow IPC file) or 'npy' (NumPy structured array),
+                     parquet and arrow need pyarrow installed, npy needs numpy"""
+    group.add_argument("--export",              dest="export",              help=export_help,                           nargs=5,    metavar=("ID", "SHEET", "RANGE", "FORMAT", "FILE"))
+    batch_get_as_json_help = """get ranges listed by JSON (e.g. ["Sheet1!A1:B2", "Sheet2!C:D", "NamedRange"]) of google drive spreadsheet ID with one request
+                                as json dict of range to values, DIMENSION, RENDER and DATETIME_RENDER are the same as for --get-as-json"""
+    group.add_argument("--batch-get-as-json",   dest="batch_get_as_json",   help=batch_get_as_json_help,                nargs=5,    metavar=("ID", "JSON", "DIMENSION", "RENDER", "DATETIME_RENDER"))
+    batch_update_data_help = """write values to ranges of google drive spreadsheet ID with one request,
+                                data is provided with JSON dict of range to values (e.g. {"Sheet1!A1:B1": [["Cell 1 1", "Cell 1 2"]], "Sheet2!C5": [["Cell"]]}),
+                                use DIMENSION = 'ROWS' or 'COLUMNS'"""
+    group.add_argument("--batch-update-data",   dest="batch_update_data",   help=batch_update_data_help,                nargs=3,    metavar=("ID", "DIMENSION", "JSON"))
     append_data_help = """append table defined by RANGE (e.g. A:B) within google drive spreadsheet ID on sheet SHEET,
                          data (one or multiple rows or columns) is provided with JSON (e.g. [["Cell 1 1", "Cell 1 2"], ["Cell 2 1", "Cell 2 2"]]),
                          use DIMENSION = 'ROWS' or 'COLUMNS'"""
     group.add_argument("--append-data",         dest="append_data",         help=append_data_help,                       nargs=5,    metavar=("ID", "SHEET", "RANGE", "DIMENSION", "JSON"))
-    args = parser.parse_args()
+    spool_data_help = """the same as --append-data, but rows are durably written to local spool directory and appended later by --flush-spool,
+                         coalesced with other rows for the same spreadsheet, sheet and range"""
+    group.add_argument("--spool-data",          dest="spool_data",          help=spool_data_help,                       nargs=5,    metavar=("ID", "SHEET", "RANGE", "DIMENSION", "JSON"))
+    flush_spool_help = "append rows from spool directory with as few requests as possible, prints JSON line with rows appended per range"
+    group.add_argument("--flush-spool",         dest="flush_spool",         help=flush_spool_help,                      action="store_true")
+    args = parser.parse_args(argv)
 
     # Set logger and console debug
     if args.debug:
@@ -65,6 +95,38 @@ if __name__ == "__main__":
             except Exception as e:
                 raise Exception('Getting spreadsheet {0} sheet {1} range {2} failed'.format(spreadsheet_id, sheet_id, range_id))
             
+        if args.get_rows:
+
+            try:
+
+                spreadsheet_id, sheet_id, range_id, render, datetime_render = args.get_rows
+
+                if args.window_rows:
+                    window_rows, = args.window_rows
+                else:
+                    window_rows = SHEETS_WINDOW_ROWS
+
+                if args.format:
+                    output_format, = args.format
+                else:
+                    output_format = "jsonl"
+
+                csv_writer = csv.writer(sys.stdout)
+                row_count = 0
+
+                for row in sheets_iter_rows(SA_SECRETS_FILE, spreadsheet_id, sheet_id, range_id, render, datetime_render, window_rows):
+                    if output_format == "csv":
+                        csv_writer.writerow(row)
+                    else:
+                        sys.stdout.write(json.dumps(row) + "\n")
+                    row_count += 1
+
+                sys.stdout.flush()
+                logger.info("{0} rows streamed".format(row_count))
+
+            except Exception as e:
+                raise Exception('Getting spreadsheet {0} sheet {1} range {2} rows failed'.format(spreadsheet_id, sheet_id, range_id))
+
         if args.append_data:
             
             try:
@@ -79,10 +141,107 @@ if __name__ == "__main__":
             except Exception as e:
                 raise Exception('Getting spreadsheet {0} sheet {1} range {2} failed'.format(spreadsheet_id, sheet_id, range_id))
             
+        if args.export:
+
+            try:
+
+                spreadsheet_id, sheet_id, range_id, output_format, output_file = args.export
+
+                if args.window_rows:
+                    window_rows, = args.window_rows
+                else:
+                    window_rows = SHEETS_WINDOW_ROWS
+
+                response = sheets_export_columns(SA_SECRETS_FILE, spreadsheet_id, sheet_id, range_id, output_file, output_format, window_rows)
+
+                print(json.dumps(response))
+                logger.info(json.dumps(response))
+
+            except Exception as e:
+                raise Exception('Exporting spreadsheet {0} sheet {1} range {2} to {3} failed: {4}'.format(spreadsheet_id, sheet_id, range_id, output_file, e))
+
+        if args.batch_get_as_json:
+
+            try:
+
+                spreadsheet_id, json_str, dimension, render, datetime_render = args.batch_get_as_json
+
+                response = sheets_batch_get_as_json(SA_SECRETS_FILE, spreadsheet_id, json.loads(json_str), dimension, render, datetime_render)
+
+                print(json.dumps(response, indent=4))
+                logger.info(json.dumps(response))
+
+            except Exception as e:
+                raise Exception('Getting spreadsheet {0} ranges {1} failed'.format(spreadsheet_id, json_str))
+
+        if args.batch_update_data:
+
+            try:
+
+                spreadsheet_id, dimension, json_str = args.batch_update_data
+
+                response = sheets_batch_update_data(SA_SECRETS_FILE, spreadsheet_id, dimension, json_str)
+                print(response)
+                logger.info(response)
+
+            except Exception as e:
+                raise Exception('Updating spreadsheet {0} ranges failed'.format(spreadsheet_id))
+            
+        if args.spool_data:
+
+            try:
+
+                spreadsheet_id, sheet_id, range_id, dimension, json_str = args.spool_data
+
+                if args.spool_dir:
+                    spool_dir, = args.spool_dir
+                else:
+                    spool_dir = SHEETS_SPOOL_DIR
+
+                spool_file = sheets_spool_data(spreadsheet_id, sheet_id, range_id, dimension, json_str, spool_dir)
+                logger.info("Spooled {0}".format(spool_file))
+
+            except Exception as e:
+                raise Exception('Spooling spreadsheet {0} sheet {1} range {2} data failed'.format(spreadsheet_id, sheet_id, range_id))
+
+        if args.flush_spool:
+
+            try:
+
+                if args.spool_dir:
+                    spool_dir, = args.spool_dir
+                else:
+                    spool_dir = SHEETS_SPOOL_DIR
+
+                while True:
+
+                    results = sheets_flush_spool(SA_SECRETS_FILE, spool_dir)
+
+                    if results is None:
+                        logger.info("Spool {0} is flushed by another process".format(spool_dir))
+                    else:
+                        for result in results:
+                            print(json.dumps(result), flush=True)
+                            logger.info(json.dumps(result))
+                        if any(['error' in result for result in results]) and not args.watch:
+                            raise Exception('Some ranges failed')
+
+                    if not args.watch:
+                        break
+
+                    time.sleep(args.watch[0])
+
+            except Exception as e:
+                raise Exception('Flushing spool {0} failed'.format(spool_dir))
+            
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
         logger.info("Finished script with errors")
-        sys.exit(1)
+        return 1
             
     logger.info("Finished script")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
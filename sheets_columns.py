@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Typed columns from sheet rows read with UNFORMATTED_VALUE and SERIAL_NUMBER render options, and columnar file writers
+# numpy and pyarrow are optional, they are imported only by writers which need them
+
+SHEETS_COLUMNS_FORMATS = ["parquet", "arrow", "npy"]
+# Serial number 0 is 1899-12-30, Unix epoch is 25569
+SHEETS_SERIAL_UNIX_EPOCH = 25569
+SHEETS_DATE_FORMAT_TYPES = ["DATE", "DATE_TIME", "TIME"]
+
+# Header cells become column names, empty and repeated names are made unique
+def sheets_columns_names(header, width):
+
+    names = []
+    seen = set()
+
+    for column_n in range(width):
+        name = str(header[column_n]) if column_n < len(header) and header[column_n] != "" else "column_{0}".format(column_n + 1)
+        unique_name = name
+        suffix = 2
+        while unique_name in seen:
+            unique_name = "{0}_{1}".format(name, suffix)
+            suffix += 1
+        seen.add(unique_name)
+        names.append(unique_name)
+
+    return names
+
+# Column type by its non empty values: bool, int, float, datetime (numbers in date formatted column) or string
+def sheets_column_type(values, date_column):
+
+    kinds = set()
+    empty = False
+
+    for value in values:
+        if value is None:
+            empty = True
+        elif isinstance(value, bool):
+            kinds.add("bool")
+        elif isinstance(value, int):
+            kinds.add("int")
+        elif isinstance(value, float):
+            kinds.add("float" if not value.is_integer() else "int")
+        else:
+            kinds.add("string")
+
+    if not kinds or "string" in kinds or ("bool" in kinds and len(kinds) > 1):
+        return "string"
+    if date_column:
+        return "datetime"
+    if kinds == {"bool"}:
+        return "bool"
+    if kinds == {"int"} and not empty:
+        return "int"
+
+    return "float"
+
+# Rows are padded lists of unformatted values, first row is header
+# date_columns is a set of column numbers (from 0) formatted as dates, their serial numbers become datetimes
+# Returns names, columns as lists with None for empty cells, and column types
+def sheets_columns_from_rows(rows, date_columns=frozenset()):
+
+    names = None
+    columns = None
+
+    for row in rows:
+
+        if names is None:
+            names = row
+            columns = [[] for value in row]
+            continue
+
+        for column_n in range(len(columns)):
+            value = row[column_n] if column_n < len(row) else ""
+            columns[column_n].append(None if value == "" else value)
+
+    if names is None:
+        return [], [], []
+
+    names = sheets_columns_names(names, len(columns))
+    types = [sheets_column_type(columns[column_n], column_n in date_columns) for column_n in range(len(columns))]
+
+    return names, columns, types
+
+def sheets_columns_numpy(column, column_type):
+
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required for columnar export, install it with: pip install numpy")
+
+    if column_type == "int":
+        return numpy.array(column, dtype=numpy.int64)
+    if column_type == "float":
+        return numpy.array([numpy.nan if value is None else value for value in column], dtype=numpy.float64)
+    if column_type == "bool":
+        # numpy bool has no empty value
+        if None in column:
+            return numpy.array([numpy.nan if value is None else float(value) for value in column], dtype=numpy.float64)
+        return numpy.array(column, dtype=numpy.bool_)
+    if column_type == "datetime":
+        millis = numpy.array([numpy.nan if value is None else (value - SHEETS_SERIAL_UNIX_EPOCH) * 86400000 for value in column], dtype=numpy.float64)
+        result = numpy.full(len(column), numpy.datetime64("NaT"), dtype="datetime64[ms]")
+        filled = ~numpy.isnan(millis)
+        result[filled] = numpy.round(millis[filled]).astype(numpy.int64).astype("datetime64[ms]")
+        return result
+
+    return numpy.array(["" if value is None else str(value) for value in column], dtype=numpy.str_)
+
+def sheets_columns_arrow_table(names, columns, types):
+
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("pyarrow is required for parquet and arrow export, install it with: pip install pyarrow")
+
+    arrays = []
+    for column, column_type in zip(columns, types):
+        if column_type == "int":
+            arrays.append(pyarrow.array(column, type=pyarrow.int64()))
+        elif column_type == "float":
+            arrays.append(pyarrow.array([None if value is None else float(value) for value in column], type=pyarrow.float64()))
+        elif column_type == "bool":
+            arrays.append(pyarrow.array(column, type=pyarrow.bool_()))
+        elif column_type == "datetime":
+            arrays.append(pyarrow.array([None if value is None else int(round((value - SHEETS_SERIAL_UNIX_EPOCH) * 86400000)) for value in column], type=pyarrow.timestamp("ms")))
+        else:
+            arrays.append(pyarrow.array([None if value is None else str(value) for value in column], type=pyarrow.string()))
+
+    return pyarrow.Table.from_arrays(arrays, names=names)
+
+# Parquet and Arrow IPC files keep empty cells as nulls, NPY file is one structured array with a field per column
+def sheets_columns_write(names, columns, types, output_file, output_format):
+
+    if output_format not in SHEETS_COLUMNS_FORMATS:
+        raise ValueError("Format {0} is not one of {1}".format(output_format, ", ".join(SHEETS_COLUMNS_FORMATS)))
+
+    if output_format == "parquet":
+
+        table = sheets_columns_arrow_table(names, columns, types)
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, output_file)
+
+    elif output_format == "arrow":
+
+        table = sheets_columns_arrow_table(names, columns, types)
+        import pyarrow
+        with pyarrow.OSFile(output_file, "wb") as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    else:
+
+        arrays = [sheets_columns_numpy(column, column_type) for column, column_type in zip(columns, types)]
+        import numpy
+        rows = len(columns[0]) if columns else 0
+        structured = numpy.empty(rows, dtype=[(name, array.dtype) for name, array in zip(names, arrays)])
+        for name, array in zip(names, arrays):
+            structured[name] = array
+        with open(output_file, "wb") as f:
+            numpy.save(f, structured, allow_pickle=False)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import fcntl
+import itertools
+import threading
+
+# Local spool directory of rows to append to sheets
+# Every write is one file, written to temp file, synced and renamed, so a file is either complete or absent after crash
+# Flusher reads pending files, appends their rows coalesced by spreadsheet, sheet and range, and removes files only after append succeeded
+# So rows are appended at least once: if flusher dies between append and removal, rows of these files are appended again by the next flusher
+
+# Appends with COLUMNS dimension are turned into rows, so that all appends to the same range could be coalesced
+def sheets_values_rows(dimension, values):
+
+    if dimension == "COLUMNS":
+        return [list(row) for row in itertools.zip_longest(*values, fillvalue="")]
+
+    return values
+
+class SheetsSpool(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def _dir(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700, exist_ok=True)
+        return self.path
+
+    def write(self, spreadsheet_id, sheet_id, range_id, dimension, values):
+
+        spool_dir = self._dir()
+
+        with self.lock:
+            seq = next(self.counter)
+
+        # Names sort in order of writing within process, and roughly by time between processes
+        name = "{0:020d}-{1}-{2}-{3}.json".format(time.time_ns(), os.getpid(), threading.get_ident(), seq)
+        tmp_path = os.path.join(spool_dir, ".{0}.tmp".format(name))
+
+        entry = {
+            'spreadsheet_id': spreadsheet_id,
+            'sheet_id': sheet_id,
+            'range_id': range_id,
+            'rows': sheets_values_rows(dimension, values)
+        }
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, os.path.join(spool_dir, name))
+
+        # Make rename itself durable
+        dir_fd = os.open(spool_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        return name
+
+    # Only one flusher works with spool at a time, returns False if another one holds the lock
+    def lock_flush(self):
+
+        self.flush_lock = open(os.path.join(self._dir(), ".flush.lock"), "w")
+
+        try:
+            fcntl.flock(self.flush_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.flush_lock.close()
+            return False
+
+        return True
+
+    def unlock_flush(self):
+        fcntl.flock(self.flush_lock, fcntl.LOCK_UN)
+        self.flush_lock.close()
+
+    # Returns dict of (spreadsheet_id, sheet_id, range_id) to list of (file name, rows, written time) in order of writing
+    def pending(self):
+
+        batches = {}
+
+        for name in sorted(os.listdir(self._dir())):
+
+            if name.startswith(".") or not name.endswith(".json"):
+                continue
+
+            with open(os.path.join(self.path, name), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+
+            key = (entry['spreadsheet_id'], entry['sheet_id'], entry['range_id'])
+            batches.setdefault(key, []).append((name, entry['rows'], int(name.split("-")[0]) / 1e9))
+
+        return batches
+
+    def remove(self, names):
+
+        for name in names:
+            os.remove(os.path.join(self.path, name))
@@ -44,7 +44,7 @@ def load_yaml(f, l):
     l.info("Loading YAML from file {0}".format(f))
     try:
         with open(f, 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file)
+            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
     except:
         raise LoadError("Reading YAML from file '{0}' failed".format(f))
     return yaml_dict
@@ -60,18 +60,28 @@ def load_file_string(f, l):
     return file_string
 
 # Set logger
-def set_logger(console_level, log_dir, log_file):
-    logger = logging.getLogger(__name__)
+# Loggers are process wide, so handlers of the previous call are replaced (e.g. previous request within daemon)
+# File handlers are kept open between calls, console handler is recreated to follow current sys.stderr
+_LOG_FILE_HANDLERS = {}
+
+def set_logger(console_level, log_dir, log_file, logger_name=__name__):
+    logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
-    if not os.path.isdir(log_dir):
-        os.mkdir(log_dir, 0o755)
-    log_handler = RotatingFileHandler("{0}/{1}".format(log_dir, log_file), maxBytes=10485760, backupCount=10, encoding="utf-8")
-    os.chmod("{0}/{1}".format(log_dir, log_file), 0o600)
-    log_handler.setLevel(logging.DEBUG)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    formatter = logging.Formatter(fmt='%(asctime)s %(filename)s %(name)s %(process)d/%(threadName)s %(levelname)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S %Z")
+    log_path = os.path.abspath("{0}/{1}".format(log_dir, log_file))
+    log_handler = _LOG_FILE_HANDLERS.get(log_path)
+    if log_handler is None:
+        if not os.path.isdir(log_dir):
+            os.mkdir(log_dir, 0o755)
+        log_handler = RotatingFileHandler(log_path, maxBytes=10485760, backupCount=10, encoding="utf-8")
+        os.chmod(log_path, 0o600)
+        log_handler.setLevel(logging.DEBUG)
+        log_handler.setFormatter(formatter)
+        _LOG_FILE_HANDLERS[log_path] = log_handler
     console_handler = logging.StreamHandler()
     console_handler.setLevel(console_level)
-    formatter = logging.Formatter(fmt='%(asctime)s %(filename)s %(name)s %(process)d/%(threadName)s %(levelname)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S %Z")
-    log_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
     logger.addHandler(log_handler)
     logger.addHandler(console_handler)